@@ -0,0 +1,287 @@
+"""
+Online backups of reels.sqlite, safe to take while a download or import is writing.
+
+Full backups copy the database with the sqlite backup API a few pages at a time,
+pausing in between so writers are never blocked for long.
+Incremental backups only store the rows that differ from the newest full backup
+(plus the keys of deleted rows), restoring one needs that full backup and the
+incremental file.
+"""
+import os
+import re
+import shutil
+import sqlite3
+import time
+import pathlib
+from datetime import datetime
+
+BACKUP_DIR = 'DB Backups'
+# only files matching these are managed (and pruned) by this module,
+# the hand made copies in DB Backups/ are left alone
+FULL_BACKUP_NAME = 'reels_{stamp}_backup.sqlite'
+INCREMENTAL_BACKUP_NAME = 'reels_{stamp}_incremental.sqlite'
+BACKUP_NAME_PATTERN = re.compile(r'^reels_(\d{4}-\d{2}-\d{2}_\d{6})_(backup|incremental)\.sqlite$')
+STAMP_FORMAT = '%Y-%m-%d_%H%M%S'
+
+# bookkeeping tables stored next to the changed rows in an incremental backup
+META_TABLE = '_backup_meta'
+TABLES_TABLE = '_backup_tables'
+DELETED_TABLE = '_backup_deleted'
+SCHEMA_TABLE = '_backup_schema'
+
+
+def quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def connect(path, readonly=False):
+    uri = pathlib.Path(path).absolute().as_uri() + ("?mode=ro" if readonly else "")
+    # autocommit, transactions are started explicitly
+    return sqlite3.connect(uri, uri=True, timeout=30, isolation_level=None)
+
+
+def list_backups(backup_dir=BACKUP_DIR):
+    """[(stamp, kind, path)] of the managed backups, oldest first"""
+    if not os.path.isdir(backup_dir):
+        return []
+    backups = []
+    for entry in os.scandir(backup_dir):
+        match = BACKUP_NAME_PATTERN.match(entry.name)
+        if match:
+            backups.append((match.group(1), match.group(2), entry.path))
+    return sorted(backups)
+
+
+def new_backup_path(backup_dir, name_format):
+    os.makedirs(backup_dir, exist_ok=True)
+    return os.path.join(backup_dir, name_format.format(stamp=datetime.now().strftime(STAMP_FORMAT)))
+
+
+def finish_file(part_path, path):
+    """fsync the finished backup and move it into place so a crash never leaves half a backup behind"""
+    with open(part_path, 'rb') as file:
+        os.fsync(file.fileno())
+    os.replace(part_path, path)
+
+
+def full_backup(db_path, backup_dir=BACKUP_DIR, pages=100, pause=0.01):
+    """
+    Copy the live database with the online backup API, `pages` pages per step with a `pause`
+    in between so writers get the lock in between steps.
+    In WAL mode the copy is read from one snapshot that writers don't have to wait for,
+    otherwise sqlite restarts the copy whenever another connection writes to the database.
+    """
+    path = new_backup_path(backup_dir, FULL_BACKUP_NAME)
+    part_path = path + '.part'
+    source = connect(db_path)
+    destination = sqlite3.connect(part_path)
+    if source.execute("PRAGMA journal_mode").fetchone()[0] == 'wal':
+        # without a pinned snapshot a busy download run would make the copy start over forever
+        source.execute("BEGIN")
+        source.execute("SELECT count(*) FROM sqlite_master").fetchone()
+
+    def progress(status, remaining, total):
+        if remaining:
+            time.sleep(pause)
+
+    start = time.time()
+    try:
+        source.backup(destination, pages=pages, progress=progress)
+        # the copy inherits WAL mode from the source, a backup is a single self contained file
+        destination.execute("PRAGMA journal_mode=DELETE")
+    finally:
+        destination.close()
+        source.close()
+    finish_file(part_path, path)
+    print(f"Full backup written to {path} ({os.path.getsize(path) / 1024:.0f} KiB in {time.time() - start:.1f}s)")
+    return path
+
+
+def user_tables(conn, schema):
+    return [name for (name,) in conn.execute(
+        f"SELECT name FROM {schema}.sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name")]
+
+
+def table_columns(conn, schema, table):
+    """[(name, type, primary key position)] in table order"""
+    return [(name, type_, pk) for _, name, type_, _, _, pk in conn.execute(f"PRAGMA {schema}.table_info({quote(table)})")]
+
+
+def primary_key(columns):
+    return [name for name, _, pk in sorted(columns, key=lambda column: column[2]) if pk]
+
+
+def incremental_backup(db_path, backup_dir=BACKUP_DIR):
+    """
+    Store the rows that were added or changed since the newest full backup and the keys of the rows
+    that were deleted. Tables that are new or whose columns changed are stored whole.
+    Takes a full backup instead when there is none to compare against.
+    """
+    full_backups = [path for _, kind, path in list_backups(backup_dir) if kind == 'backup']
+    if not full_backups:
+        print("No full backup to compare against yet, taking a full backup instead")
+        return full_backup(db_path, backup_dir)
+    base_path = full_backups[-1]
+
+    path = new_backup_path(backup_dir, INCREMENTAL_BACKUP_NAME)
+    part_path = path + '.part'
+    if os.path.exists(part_path):
+        os.remove(part_path)
+
+    start = time.time()
+    conn = connect(part_path)
+    try:
+        conn.execute("ATTACH DATABASE ? AS src", (pathlib.Path(db_path).absolute().as_uri() + "?mode=ro",))
+        conn.execute("ATTACH DATABASE ? AS base", (pathlib.Path(base_path).absolute().as_uri() + "?mode=ro",))
+        conn.execute(f"CREATE TABLE {META_TABLE} (key TEXT PRIMARY KEY, value TEXT)")
+        conn.execute(f"CREATE TABLE {TABLES_TABLE} (name TEXT PRIMARY KEY, mode TEXT, changed INTEGER, deleted INTEGER)")
+        conn.execute(f"CREATE TABLE {DELETED_TABLE} (tbl TEXT, key TEXT)")
+        conn.execute(f"CREATE TABLE {SCHEMA_TABLE} (type TEXT, name TEXT, tbl_name TEXT, sql TEXT)")
+
+        # every read of src below happens inside this transaction, i.e. from the same snapshot
+        conn.execute("BEGIN")
+        conn.execute(f"""INSERT INTO {SCHEMA_TABLE} SELECT type, name, tbl_name, sql FROM src.sqlite_master
+                         WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%'""")
+        base_tables = set(user_tables(conn, 'base'))
+        total_changed = total_deleted = 0
+        for table in user_tables(conn, 'src'):
+            columns = table_columns(conn, 'src', table)
+            key = primary_key(columns)
+            (create_sql,) = conn.execute("SELECT sql FROM src.sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+            conn.execute(create_sql)
+
+            if table in base_tables and key and table_columns(conn, 'base', table) == columns:
+                mode = 'diff'
+                changed = conn.execute(f"""INSERT INTO main.{quote(table)}
+                                           SELECT * FROM src.{quote(table)} EXCEPT SELECT * FROM base.{quote(table)}""").rowcount
+                same_key = " AND ".join(f"s.{quote(column)} = b.{quote(column)}" for column in key)
+                deleted = conn.execute(f"""INSERT INTO {DELETED_TABLE} (tbl, key)
+                                           SELECT ?, json_array({', '.join(f'b.{quote(column)}' for column in key)})
+                                           FROM base.{quote(table)} b
+                                           WHERE NOT EXISTS (SELECT 1 FROM src.{quote(table)} s WHERE {same_key})""",
+                                       (table,)).rowcount
+            else:
+                # new table, changed columns or no primary key to match rows on
+                mode = 'full'
+                changed = conn.execute(f"INSERT INTO main.{quote(table)} SELECT * FROM src.{quote(table)}").rowcount
+                deleted = 0
+            conn.execute(f"INSERT INTO {TABLES_TABLE} VALUES (?, ?, ?, ?)", (table, mode, changed, deleted))
+            total_changed += changed
+            total_deleted += deleted
+
+        for table in base_tables - set(user_tables(conn, 'src')):
+            conn.execute(f"INSERT INTO {TABLES_TABLE} VALUES (?, 'dropped', 0, 0)", (table,))
+            total_deleted += 1
+
+        conn.executemany(f"INSERT INTO {META_TABLE} VALUES (?, ?)", [
+            ('base', os.path.basename(base_path)),
+            ('source', os.path.abspath(db_path)),
+            ('created_at', datetime.now().isoformat()),
+        ])
+        conn.execute("COMMIT")
+        conn.execute("DETACH DATABASE src")
+        conn.execute("DETACH DATABASE base")
+    finally:
+        conn.close()
+
+    if not total_changed and not total_deleted:
+        os.remove(part_path)
+        print(f"No changes since {base_path}, nothing to back up")
+        return None
+
+    finish_file(part_path, path)
+    print(f"Incremental backup written to {path} ({total_changed} changed rows, {total_deleted} deleted, "
+          f"{os.path.getsize(path) / 1024:.0f} KiB in {time.time() - start:.1f}s, based on {os.path.basename(base_path)})")
+    return path
+
+
+def prune_backups(backup_dir=BACKUP_DIR, keep=5):
+    """
+    Keep the newest `keep` full backups and the newest `keep` incremental backups.
+    Incremental backups whose full backup was removed are useless and removed too.
+    """
+    if keep <= 0:
+        return []
+    backups = list_backups(backup_dir)
+    full_backups = [path for _, kind, path in backups if kind == 'backup']
+    kept_full = set(os.path.basename(path) for path in full_backups[-keep:])
+    removed = full_backups[:-keep]
+
+    incrementals = [path for _, kind, path in backups if kind == 'incremental']
+    removed += incrementals[:-keep]
+    for path in incrementals[-keep:]:
+        if backup_base(path) not in kept_full:
+            removed.append(path)
+
+    for path in removed:
+        os.remove(path)
+        print(f"Removed old backup {path}")
+    return removed
+
+
+def backup_base(path):
+    """Name of the full backup an incremental backup is based on"""
+    conn = connect(path, readonly=True)
+    try:
+        row = conn.execute(f"SELECT value FROM {META_TABLE} WHERE key = 'base'").fetchone()
+    finally:
+        conn.close()
+    return row[0] if row else None
+
+
+def backup(db_path, backup_dir=BACKUP_DIR, incremental=False, keep=5, pages=100, pause=0.01):
+    if incremental:
+        path = incremental_backup(db_path, backup_dir)
+    else:
+        path = full_backup(db_path, backup_dir, pages, pause)
+    prune_backups(backup_dir, keep)
+    return path
+
+
+def apply_incremental(conn):
+    """Apply the attached incremental backup `inc` to the main database of conn"""
+    tables = conn.execute(f"SELECT name, mode FROM inc.{TABLES_TABLE}").fetchall()
+    for table, mode in tables:
+        if mode == 'diff':
+            key = primary_key(table_columns(conn, 'main', table))
+            key_values = ", ".join(f"json_extract(key, '$[{i}]')" for i in range(len(key)))
+            conn.execute(f"""DELETE FROM main.{quote(table)}
+                             WHERE ({', '.join(quote(column) for column in key)}) IN
+                                   (SELECT {key_values} FROM inc.{DELETED_TABLE} WHERE tbl = ?)""", (table,))
+            conn.execute(f"INSERT OR REPLACE INTO main.{quote(table)} SELECT * FROM inc.{quote(table)}")
+        else:
+            # dropped, or stored whole: rebuild it with the schema (and indexes) it had at backup time
+            conn.execute(f"DROP TABLE IF EXISTS main.{quote(table)}")
+            if mode == 'full':
+                for (sql,) in conn.execute(f"""SELECT sql FROM inc.{SCHEMA_TABLE} WHERE tbl_name = ?
+                                               ORDER BY type = 'table' DESC""", (table,)).fetchall():
+                    conn.execute(sql)
+                conn.execute(f"INSERT INTO main.{quote(table)} SELECT * FROM inc.{quote(table)}")
+
+
+def restore_backup(backup_path, db_path):
+    """Rebuild the database from a full backup, or from an incremental backup and its full backup"""
+    if os.path.exists(db_path):
+        print(f"{db_path} already exists, move it away first or restore to a different --db")
+        return None
+
+    base = backup_base(backup_path) if backup_path.endswith('_incremental.sqlite') else None
+    base_path = os.path.join(os.path.dirname(backup_path), base) if base else backup_path
+    if not os.path.exists(base_path):
+        print(f"{backup_path} is based on {base_path}, which no longer exists")
+        return None
+
+    part_path = db_path + '.part'
+    shutil.copyfile(base_path, part_path)
+    if base:
+        conn = connect(part_path)
+        try:
+            conn.execute("ATTACH DATABASE ? AS inc", (pathlib.Path(backup_path).absolute().as_uri() + "?mode=ro",))
+            conn.execute("BEGIN")
+            apply_incremental(conn)
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+    finish_file(part_path, db_path)
+    print(f"Restored {backup_path}" + (f" on top of {base_path}" if base else "") + f" to {db_path}")
+    return db_path
@@ -0,0 +1,98 @@
+"""
+Chunk size fuzz check of iter_json_array against json.load.
+
+Random takeout shaped documents (numbers, literals, strings with escapes, nested values and
+other keys before and after the array) are read with every chunk size from 1 up to the
+length of the document, the elements have to match what json.load finds under the key.
+
+    python benchmarks/json_stream.py [--documents 200] [--seed 0]
+"""
+import argparse
+import io
+import json
+import os
+import random
+import sys
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from utils import iter_json_array
+
+KEY = 'saved_saved_media'
+
+
+def random_scalar(rng):
+    return rng.choice([
+        lambda: rng.randint(-10 ** 12, 10 ** 12),
+        lambda: rng.choice([0, 1, -1, 10, -2]),
+        lambda: round(rng.uniform(-1e3, 1e3), rng.randint(0, 6)),
+        lambda: rng.choice([1.5, 0.1, -2.5e10, 1e-7, 3e+20]),
+        lambda: rng.choice([True, False, None]),
+        lambda: rng.choice(['', 'a', 'x' * 40, 'quote " slash \\ tab \t', 'é ✓  ', 'http://example.com/p/a_b/?x=1']),
+    ])()
+
+
+def random_value(rng, depth=0):
+    kind = rng.random()
+    if depth < 3 and kind < 0.2:
+        return [random_value(rng, depth + 1) for _ in range(rng.randint(0, 4))]
+    if depth < 3 and kind < 0.4:
+        return {f"k{i}": random_value(rng, depth + 1) for i in range(rng.randint(0, 4))}
+    return random_scalar(rng)
+
+
+def random_document(rng):
+    document = {}
+    for i in range(rng.randint(0, 2)):
+        document[f"before{i}"] = random_value(rng)
+    document[KEY] = [random_value(rng) for _ in range(rng.randint(0, 6))]
+    for i in range(rng.randint(0, 2)):
+        document[f"after{i}"] = random_value(rng)
+    indent = rng.choice([None, None, 1, 4])
+    separators = rng.choice([(',', ':'), (', ', ': '), None])
+    return json.dumps(document, indent=indent, separators=separators, ensure_ascii=rng.random() < 0.5)
+
+
+def check(text):
+    """Returns the chunk sizes for which iter_json_array does not match json.load"""
+    expected = json.loads(text)[KEY]
+    failed = []
+    for chunk_size in range(1, len(text) + 2):
+        try:
+            found = list(iter_json_array(io.StringIO(text), KEY, chunk_size))
+        except ValueError as e:
+            found = e
+        if found != expected:
+            failed.append((chunk_size, found))
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--documents', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    # the cases that used to be cut at a chunk boundary, then random ones
+    documents = [
+        '{"saved_saved_media":[1.5]}',
+        '{"saved_saved_media":[-2.5e10]}',
+        '{"saved_saved_media":[0.1, 1]}',
+        '{"other": 12.75, "saved_saved_media": [true, null, 1e5], "after": -0.5}',
+    ] + [random_document(rng) for _ in range(args.documents)]
+
+    failures = 0
+    for text in documents:
+        failed = check(text)
+        if failed:
+            failures += 1
+            chunk_size, found = failed[0]
+            print(f"{len(failed)} chunk sizes fail, first {chunk_size} gave {found!r} for {text[:200]}")
+    print(f"{len(documents)} documents, {failures} failed")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+Startup time of every db.py command.
+
+Each command is run a few times in a fresh interpreter against a throwaway copy of
+the database (with inputs that make it do as little work as possible) and reports
+the median wall time, the time spent importing modules and the heaviest imports.
+
+    python benchmarks/startup.py [--db reels.sqlite] [--repeat 5] [--json out.json]
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# action -> extra arguments that make it a (near) no-op
+COMMANDS = {
+    'find-link': ['--id=-missing-'],
+    'sync-download-status': ['--dry-run'],
+    'add-new-posts': ['--file', 'takeout/instagram-x/your_instagram_activity/saved/saved_posts.json', '--bulk', '--force'],
+    'import-takeouts': ['--root', 'takeout'],
+    'remove-duplicates': [],
+    'download': ['--limit', '0'],
+}
+
+INTERPRETER_MODULES = {'site', 'encodings', 'zipimport', 'codecs', 'io', 'abc', 'os', 'stat', 'posixpath', 'genericpath'}
+
+
+def parse_importtime(stderr):
+    """Returns (total import microseconds, [(cumulative us, module)] of top level imports)"""
+    top_level = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        _, self_us, cumulative_us, name = line.replace('import time:', '|').split('|')
+        # one separating space, then two more per nesting level
+        name = name[1:].rstrip()
+        # top level imports are not indented; site & co. are paid by every interpreter
+        if not name.startswith(' ') and name not in INTERPRETER_MODULES:
+            top_level.append((int(cumulative_us), name))
+    return sum(us for us, _ in top_level), sorted(top_level, reverse=True)
+
+
+def run_once(workdir, action, extra_args):
+    command = [sys.executable, '-X', 'importtime', os.path.join(REPO, 'db.py'), action, '--db', 'reels.sqlite'] + extra_args
+    start = time.perf_counter()
+    result = subprocess.run(command, cwd=workdir, capture_output=True, text=True)
+    wall = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f"{action} failed:\n{result.stderr[-2000:]}")
+    import_us, modules = parse_importtime(result.stderr)
+    return wall, import_us / 1e6, modules
+
+
+def make_workdir(db_path):
+    workdir = tempfile.mkdtemp(prefix='startup_bench_')
+    shutil.copy(db_path, os.path.join(workdir, 'reels.sqlite'))
+    saved = os.path.join(workdir, 'takeout', 'instagram-x', 'your_instagram_activity', 'saved')
+    os.makedirs(saved)
+    with open(os.path.join(saved, 'saved_posts.json'), 'w') as f:
+        json.dump({'saved_saved_media': []}, f)
+    return workdir
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure startup / import time of every db.py command')
+    parser.add_argument('--db', default=os.path.join(REPO, 'reels.sqlite'), help='Database to copy for the runs')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--commands', nargs='*', default=list(COMMANDS), choices=list(COMMANDS))
+    parser.add_argument('--json', help='Also write the results to this file')
+    args = parser.parse_args()
+
+    workdir = make_workdir(args.db)
+    results = {}
+    try:
+        print(f"{'command':<22}{'wall ms':>10}{'import ms':>12}  heaviest imports")
+        for action in args.commands:
+            runs = [run_once(workdir, action, COMMANDS[action]) for _ in range(args.repeat)]
+            wall = statistics.median(run[0] for run in runs)
+            imports = statistics.median(run[1] for run in runs)
+            heaviest = [(name, round(us / 1000, 1)) for us, name in runs[-1][2][:3]]
+            results[action] = {'wall_ms': round(wall * 1000, 1), 'import_ms': round(imports * 1000, 1), 'heaviest_imports_ms': heaviest}
+            print(f"{action:<22}{wall * 1000:>10.1f}{imports * 1000:>12.1f}  " + ", ".join(f"{name} {ms}" for name, ms in heaviest))
+    finally:
+        shutil.rmtree(workdir)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
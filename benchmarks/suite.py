@@ -0,0 +1,209 @@
+"""
+Benchmarks for ingest, dedup, sync and the download queue on synthetic data.
+
+For every scale a synthetic takeout is generated, and every operation runs in its own
+interpreter on a fresh copy of the data, reporting wall time, peak RSS and the number
+of SQL statements it executed.
+
+    python benchmarks/suite.py [--scales 1000 10000 100000] [--ops ...] [--json out.json]
+
+Operations:
+    add-new-posts           per row ingest of both takeout files into an empty db
+    add-new-posts-bulk      the --bulk ingest of both files into an empty db
+    import-takeouts         import-takeouts of the takeout folder into an empty db
+    remove-duplicates       on a db where non collection posts were later saved into collections
+    sync-download-status    against a media tree with missing, misplaced, manual and stray files
+    download-queue          count the backlog and read the whole download queue
+    download                download --download-limit posts through the local media server
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARKS)
+
+import synthetic
+
+OPERATIONS = ['add-new-posts', 'add-new-posts-bulk', 'import-takeouts', 'remove-duplicates',
+              'sync-download-status', 'download-queue', 'download']
+# operations that start from an empty db, the others start from the prepared one
+INGEST_OPERATIONS = ['add-new-posts', 'add-new-posts-bulk', 'import-takeouts']
+
+
+def prepare(workdir, scale, duplicate_ratio, seed):
+    """Takeout files and a populated db shared by every operation of a scale"""
+    takeout_root = os.path.join(workdir, 'takeout')
+    saved_folder = synthetic.generate_takeout(takeout_root, scale, duplicate_ratio, seed=seed)
+
+    # non collection posts first: posts later saved into a collection become remove-duplicates work
+    base_db = os.path.join(workdir, 'base.sqlite')
+    run_child('prepare-db', workdir, base_db, {'saved_folder': saved_folder})
+    return takeout_root, saved_folder, base_db
+
+
+def run_child(operation, workdir, db_path, options):
+    """Run one operation in a fresh interpreter, returns the result it reports"""
+    result_path = os.path.join(workdir, 'result.json')
+    command = [sys.executable, os.path.abspath(__file__), '--child', operation,
+               '--workdir', workdir, '--db', db_path, '--options', json.dumps(options), '--result', result_path]
+    process = subprocess.run(command, cwd=workdir, capture_output=True, text=True)
+    if process.returncode != 0:
+        raise RuntimeError(f"{operation} failed:\n{process.stderr[-3000:]}")
+    with open(result_path) as f:
+        return json.load(f)
+
+
+def run_operation(operation, workdir, takeout_root, saved_folder, base_db, options):
+    """Fresh copies of the db and media tree, then the operation itself in a child process"""
+    run_dir = os.path.join(workdir, 'run')
+    if os.path.exists(run_dir):
+        shutil.rmtree(run_dir)
+    os.makedirs(run_dir)
+    db_path = os.path.join(run_dir, 'reels.sqlite')
+    if operation not in INGEST_OPERATIONS:
+        shutil.copy(base_db, db_path)
+        synthetic.make_media_tree(run_dir, db_path, seed=options['seed'])
+    return run_child(operation, run_dir, db_path, dict(options, takeout_root=takeout_root, saved_folder=saved_folder))
+
+
+def child(operation, workdir, db_path, options, result_path):
+    """Runs inside the child process: set up, run and measure a single operation"""
+    import contextlib
+    import resource
+    from sqlalchemy import event
+
+    import commands
+
+    # commands find the media folders in the working directory or in MEDIA_ROOT
+    commands.MEDIA_ROOT = workdir
+    collection_file = os.path.join(options['saved_folder'], 'saved_collections.json')
+    non_collection_file = os.path.join(options['saved_folder'], 'saved_posts.json')
+
+    engine, session = commands.get_session(db_path)
+    statements = [0]
+
+    def count_statement(*args):
+        statements[0] += 1
+    event.listen(engine, 'before_cursor_execute', count_statement)
+
+    def run():
+        details = {}
+        if operation == 'prepare-db':
+            commands.add_new_posts_bulk(session, non_collection_file)
+            commands.add_new_posts_bulk(session, collection_file)
+        elif operation == 'add-new-posts':
+            commands.add_new_posts(session, collection_file)
+            commands.add_new_posts(session, non_collection_file)
+        elif operation == 'add-new-posts-bulk':
+            commands.add_new_posts_bulk(session, collection_file)
+            commands.add_new_posts_bulk(session, non_collection_file)
+        elif operation == 'import-takeouts':
+            commands.import_takeouts(session, options['takeout_root'])
+        elif operation == 'remove-duplicates':
+            commands.remove_duplicates(session)
+        elif operation == 'sync-download-status':
+            commands.sync_download_status(session)
+        elif operation == 'download-queue':
+            details['backlog'] = commands.count_download_backlog(session)
+            details['queued'] = sum(1 for _ in commands.iter_download_queue(session, page_size=100))
+        elif operation == 'download':
+            with synthetic.MediaServer(size=options['media_size']) as server:
+                synthetic.FakeDownloader.base_url = server.url
+                commands.Downloader = synthetic.FakeDownloader
+                commands.download_new_posts(session, workers=options['workers'], limit=options['download_limit'],
+                                            batch_size=50, rate=10000, max_rate=10000, media_rate=10000)
+            details['failed'] = session.execute(commands.text("SELECT count(*) FROM download_attempts")).scalar()
+        return details
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    # the commands print every post, that is not what is being measured
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        details = run()
+    wall = time.perf_counter() - start
+
+    details['posts'] = session.execute(commands.text("SELECT count(*) FROM posts")).scalar()
+    session.close()
+    engine.dispose()
+    with open(result_path, 'w') as f:
+        json.dump({
+            'wall_s': wall,
+            # ru_maxrss is in KiB on linux
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'rss_before_mb': rss_before / 1024,
+            'statements': statements[0],
+            'details': details,
+        }, f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark ingest, dedup, sync and download queue on synthetic takeouts')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='Number of takeout entries to generate')
+    parser.add_argument('--ops', nargs='+', choices=OPERATIONS, default=OPERATIONS)
+    parser.add_argument('--duplicate-ratio', type=float, default=0.2,
+                        help='Share of takeout entries that repeat an earlier post')
+    parser.add_argument('--download-limit', type=int, default=200,
+                        help='Posts fetched by the download benchmark')
+    parser.add_argument('--workers', type=int, default=4, help='Download threads (download)')
+    parser.add_argument('--media-size', type=int, default=64 * 1024, help='Bytes served per media file (download)')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs per operation, the median is reported')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', help='Keep the generated data here instead of a temporary folder')
+    parser.add_argument('--json', help='Also write the results to this file')
+    # used by the parent to run a single operation
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--db', help=argparse.SUPPRESS)
+    parser.add_argument('--options', help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.workdir, args.db, json.loads(args.options), args.result)
+        return
+
+    options = {
+        'seed': args.seed,
+        'download_limit': args.download_limit,
+        'workers': args.workers,
+        'media_size': args.media_size,
+    }
+    results = []
+    print(f"{'posts':>8}  {'operation':<22}{'wall s':>9}{'peak MB':>9}{'stmts':>9}  details")
+    for scale in args.scales:
+        workdir = os.path.join(args.workdir, str(scale)) if args.workdir else tempfile.mkdtemp(prefix=f'reels_bench_{scale}_')
+        os.makedirs(workdir, exist_ok=True)
+        try:
+            takeout_root, saved_folder, base_db = prepare(workdir, scale, args.duplicate_ratio, args.seed)
+            for operation in args.ops:
+                runs = [run_operation(operation, workdir, takeout_root, saved_folder, base_db, options)
+                        for _ in range(args.repeat)]
+                result = {
+                    'scale': scale,
+                    'operation': operation,
+                    'wall_s': round(statistics.median(run['wall_s'] for run in runs), 3),
+                    'peak_rss_mb': round(max(run['peak_rss_mb'] for run in runs), 1),
+                    'statements': runs[-1]['statements'],
+                    'details': runs[-1]['details'],
+                }
+                results.append(result)
+                details = ", ".join(f"{key} {value}" for key, value in result['details'].items())
+                print(f"{scale:>8}  {operation:<22}{result['wall_s']:>9.3f}{result['peak_rss_mb']:>9.1f}{result['statements']:>9}  {details}")
+        finally:
+            if not args.workdir:
+                shutil.rmtree(workdir)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+"""
+Synthetic data for the benchmarks: instagram takeouts, media folders and a stand-in
+for instagram's download path. Everything is generated from a seed so runs are repeatable.
+"""
+import http.server
+import json
+import os
+import random
+import re
+import sqlite3
+import sys
+import threading
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from utils import MEDIA_FOLDERS, Downloader, media_folder
+
+SHORTCODE_CHARS = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_-"
+# (url kind, share of posts)
+POST_KINDS = [('reel', 0.8), ('p', 0.15), ('tv', 0.05)]
+COLLECTIONS = ['flirt', 'Gym', 'Marriage', 'Food', 'Travel', 'Music', 'Memes', 'Tech']
+START_TIMESTAMP = 1609459200  # 2021-01-01
+
+
+def random_url(rng):
+    kind = rng.choices([kind for kind, _ in POST_KINDS], [share for _, share in POST_KINDS])[0]
+    shortcode = "".join(rng.choice(SHORTCODE_CHARS) for _ in range(11))
+    url = f"https://www.instagram.com/{kind}/{shortcode}/"
+    # the same post shows up with tracking parameters now and then
+    if rng.random() < 0.1:
+        url += f"?igsh={rng.randrange(10 ** 8)}"
+    return url
+
+
+def generate_takeout(root, posts, duplicate_ratio=0.2, collection_share=0.6, collections=5, seed=0):
+    """
+    Write root/instagram-bench/your_instagram_activity/saved/saved_collections.json and saved_posts.json
+    with `posts` entries between them. duplicate_ratio of the entries re-use a post that was already
+    written (into the same collection, another collection or the non collection list).
+    Returns the saved folder.
+    """
+    rng = random.Random(seed)
+    saved_folder = os.path.join(root, 'instagram-bench', 'your_instagram_activity', 'saved')
+    os.makedirs(saved_folder, exist_ok=True)
+    names = COLLECTIONS[:collections]
+
+    seen = []
+
+    def next_post():
+        if seen and rng.random() < duplicate_ratio:
+            return rng.choice(seen)
+        post = (random_url(rng), f"account_{rng.randrange(max(posts // 20, 1))}")
+        seen.append(post)
+        return post
+
+    collection_posts = {name: [] for name in names}
+    non_collection_posts = []
+    for i in range(posts):
+        timestamp = START_TIMESTAMP + i * 60
+        if rng.random() < collection_share:
+            collection_posts[rng.choice(names)].append((next_post(), timestamp))
+        else:
+            non_collection_posts.append((next_post(), timestamp))
+
+    entries = []
+    for name in names:
+        entries.append({"title": "", "string_map_data": {"Name": {"value": name}}})
+        for (url, account), timestamp in collection_posts[name]:
+            entries.append({"string_map_data": {"Name": {"value": account, "href": url}, "Added Time": {"timestamp": timestamp}}})
+    with open(os.path.join(saved_folder, 'saved_collections.json'), 'w') as f:
+        json.dump({"saved_saved_collections": entries}, f)
+
+    entries = [{"title": account, "string_map_data": {"Saved on": {"href": url, "timestamp": timestamp}}}
+               for (url, account), timestamp in non_collection_posts]
+    with open(os.path.join(saved_folder, 'saved_posts.json'), 'w') as f:
+        json.dump({"saved_saved_media": entries}, f)
+    return saved_folder
+
+
+def make_media_tree(media_root, db_path, downloaded_ratio=0.5, missing_ratio=0.02, misplaced_ratio=0.02,
+                    manual_ratio=0.02, stray_files=100, seed=0):
+    """
+    Mark downloaded_ratio of the posts downloaded and create their (empty) files under media_root.
+    Some of them lose their file (missing_ratio) or sit in the folder of the other kind (misplaced_ratio),
+    some posts not marked downloaded get a file anyway (manual_ratio) and a few files belong to no post,
+    so sync-download-status has something of everything to do.
+    Returns {what: count}.
+    """
+    rng = random.Random(seed)
+    for folder in MEDIA_FOLDERS:
+        os.makedirs(os.path.join(media_root, folder), exist_ok=True)
+
+    conn = sqlite3.connect(db_path)
+    # ids are random, (shortcode, collection) is unique and the same on every run
+    rows = conn.execute("SELECT id, collection, post_type FROM posts ORDER BY shortcode, collection").fetchall()
+    counts = dict.fromkeys(['downloaded', 'missing', 'misplaced', 'manual', 'stray'], 0)
+    downloaded_ids = []
+    for post_id, collection, post_type in rows:
+        downloaded = rng.random() < downloaded_ratio
+        if downloaded:
+            downloaded_ids.append(post_id)
+            counts['downloaded'] += 1
+            if rng.random() < missing_ratio:
+                counts['missing'] += 1
+                continue
+        elif rng.random() < manual_ratio:
+            counts['manual'] += 1
+        else:
+            continue
+        is_collection = collection is not None
+        if rng.random() < misplaced_ratio:
+            is_collection = not is_collection
+            counts['misplaced'] += 1
+        write_media(media_root, post_id, is_collection, post_type == 'REEL')
+
+    # 0 is not in the id alphabet, these never match a post
+    for i in range(min(stray_files, 1000)):
+        write_media(media_root, f"0{i:03d}", rng.random() < 0.5, True)
+        counts['stray'] += 1
+
+    conn.execute("UPDATE posts SET is_downloaded = 0")
+    for start in range(0, len(downloaded_ids), 500):
+        chunk = downloaded_ids[start:start + 500]
+        conn.execute(f"UPDATE posts SET is_downloaded = 1 WHERE id IN ({', '.join('?' * len(chunk))})", chunk)
+    conn.commit()
+    conn.close()
+    return counts
+
+
+def write_media(media_root, post_id, is_collection, is_reel):
+    folder = os.path.join(media_root, media_folder(is_collection, is_reel))
+    if is_reel:
+        open(os.path.join(folder, post_id + '.mp4'), 'wb').close()
+    else:
+        os.makedirs(os.path.join(folder, post_id), exist_ok=True)
+        open(os.path.join(folder, post_id, '0.jpeg'), 'wb').close()
+
+
+class MediaHandler(http.server.BaseHTTPRequestHandler):
+    """Serves server.body for every path, with Range support like instagram's CDN"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = self.server.body
+        start = 0
+        match = re.match(r'bytes=(\d+)-', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(body)}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(body) - 1}/{len(body)}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body) - start))
+        self.end_headers()
+        self.wfile.write(body[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+class MediaServer:
+    """Local HTTP server standing in for the CDN, use as a context manager"""
+    def __init__(self, size=64 * 1024, seed=0):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), MediaHandler)
+        self.server.daemon_threads = True
+        self.server.body = random.Random(seed).randbytes(size)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakePost:
+    """
+    The attributes of instaloader.Post that the download path reads.
+    download_reel only reads video_url, download_photo gets a single image.
+    """
+    def __init__(self, base_url, shortcode):
+        self.typename = 'GraphImage'
+        self.is_video = False
+        self.video_url = f"{base_url}/{shortcode}.mp4"
+        self.url = f"{base_url}/{shortcode}.jpeg"
+
+
+class FakeDownloader(Downloader):
+    """
+    Downloader whose post lookups never reach instagram: get_post answers from the local
+    MediaServer (still going through the rate limiter), media is fetched from it over HTTP.
+    Set FakeDownloader.base_url before use.
+    """
+    base_url = None
+
+    def get_post(self, shortcode):
+        self.limiter.acquire()
+        self.limiter.success()
+        return FakePost(self.base_url, shortcode)
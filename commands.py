@@ -0,0 +1,1106 @@
+from sqlalchemy import and_, or_, select, insert, update, delete, func, text, table, column, tuple_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from datetime import datetime, timedelta
+import json
+from subprocess import call
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
+
+from models import *
+from utils import *
+import metrics
+
+# where the reels/ and reels_non_collection/ folders live
+MEDIA_ROOT = "/home/namit/Downloads/ig_saved"
+
+def find_ingested_file(session, content_hash):
+    return session.query(IngestedFile).filter(IngestedFile.content_hash==content_hash).first()
+
+def record_ingested_file(session, file, content_hash, inserted, skipped):
+    stat = os.stat(file)
+    session.add(IngestedFile(
+        path=os.path.abspath(file),
+        size=stat.st_size,
+        mtime=stat.st_mtime,
+        content_hash=content_hash,
+        inserted=inserted,
+        skipped=skipped))
+
+def known_content_hashes(session, files):
+    """{file: content hash} of the files whose path, size and mtime match a ledger row, they are not hashed again"""
+    ledger = {(path, size, mtime): content_hash for path, size, mtime, content_hash in session.execute(
+        select(IngestedFile.path, IngestedFile.size, IngestedFile.mtime, IngestedFile.content_hash))}
+    known = {}
+    for file in files:
+        stat = os.stat(file)
+        content_hash = ledger.get((os.path.abspath(file), stat.st_size, stat.st_mtime))
+        if content_hash is not None:
+            known[file] = content_hash
+    return known
+
+def already_ingested(session, file, content_hash, force):
+    """Check the ledger and explain why the file is being skipped"""
+    previous = find_ingested_file(session, content_hash)
+    if previous is None:
+        return False
+    if force:
+        print(f"{file} was already added on {previous.ingested_at} (same content as {previous.path}). Re-adding because of --force")
+        return False
+    print(f"Skipping {file}, already added on {previous.ingested_at} (same content as {previous.path}). Use --force to add it again")
+    return True
+
+def add_new_posts(session, file, force=False):
+
+    content_hash = known_content_hashes(session, [file]).get(file) or file_sha256(file)
+    if already_ingested(session, file, content_hash, force):
+        return
+
+    file_type = detect_file_type(file)
+    with metrics.phase('parse'):
+        # open the takout file
+        with open(file) as f:
+            new_saved_posts_raw = json.load(f)
+
+        if file_type == "collection":
+            # convert takeout from insta format to a dictionary of collections
+            new_saved_posts = parse_saved_posts(new_saved_posts_raw)
+        elif file_type == "non_collection":
+            # it is a list of posts that do not belong to a collection
+            new_saved_posts = parse_non_collection_saved_posts(new_saved_posts_raw)
+
+    # every id in the db, loaded once so new ids never need a lookup
+    with metrics.phase('load ids'):
+        ids = load_id_allocator(session)
+    
+
+    if file_type == "collection":
+        # for each post check
+        # - same uuid doesn't already exist
+        # - the same post url - collection combination does not exist
+        # (same post can exist multiple times but with different collection)
+        inserted, skipped = 0, 0
+        for collection_name in new_saved_posts.keys():
+            for p in new_saved_posts[collection_name]:
+                assert collection_name == p['collection']
+
+                # look for another row with the same post (shortcode) - collection pair
+                duplicate_entry_count = session.query(Post)\
+                    .filter(
+                        and_(
+                            Post.shortcode == p['shortcode'],
+                            Post.collection == p['collection']
+                        )
+                    )\
+                    .count()
+                if duplicate_entry_count > 0:
+                    # print("Post Being Skipped: ", p)
+                    skipped += 1
+                    continue
+
+                new_post = Post(
+                    id=ids.allocate(),
+                    account=p['account'],
+                    url=p['url'],
+                    shortcode=p['shortcode'],
+                    date_saved=p['date_saved'],
+                    collection=p['collection'],
+                    post_type=PostType(p['post_type']))
+                
+                metrics.log(new_post)
+                session.add(new_post)
+                inserted += 1
+        record_ingested_file(session, file, content_hash, inserted, skipped)
+        with metrics.phase('commit'):
+            session.commit()
+    elif file_type == "non_collection":
+        # for each post check
+        # - same uuid doesn't already exist
+        # - same url doesn't already exist
+        inserted, skipped = 0, 0
+        for p in new_saved_posts:
+            # query all the rows for the same url 
+            # if found skip it because 
+            # if it is a pre-existing collection row then it has no business beng a non-collection row
+            # if it is a pre-existing non-collection row then it will lead to duplication
+            # insta is sending bad quality data
+            posts_with_same_url = session.query(Post).filter(Post.shortcode==p['shortcode']).all()
+            if len(posts_with_same_url) > 0:
+                metrics.log(f"Skipping. Existing post(s) IDs: ")
+                [metrics.log(f"ID: {duplicate_post.id} | account: {duplicate_post.account}") for duplicate_post in posts_with_same_url]
+                metrics.log("X"*50)
+                skipped += 1
+                continue
+
+            new_post = Post(
+                id=ids.allocate(),
+                account=p['account'],
+                url=p['url'],
+                shortcode=p['shortcode'],
+                date_saved=p['date_saved'],
+                collection=p['collection'],
+                post_type=PostType(p['post_type']))
+            
+            metrics.log(new_post)
+            session.add(new_post)
+            inserted += 1
+        record_ingested_file(session, file, content_hash, inserted, skipped)
+        with metrics.phase('commit'):
+            session.commit()
+
+    metrics.count('posts inserted', inserted)
+    metrics.count('posts skipped', skipped)
+    print(ids)
+
+def load_id_allocator(session):
+    return IdAllocator(session.scalars(select(Post.id)))
+
+class PostIndex:
+    """
+    In memory copy of everything add_new_posts needs to dedup against.
+    Loaded with a single query so ingestion does not hit the db once per post.
+    """
+    def __init__(self, session):
+        # ids are allocated here, unique within a batch and against the db
+        self.ids = IdAllocator()
+        self.shortcodes = set()
+        self.shortcode_collections = set()
+        for post_id, shortcode, collection in session.execute(select(Post.id, Post.shortcode, Post.collection)):
+            self.add(post_id, shortcode, collection)
+
+    def add(self, post_id, shortcode, collection):
+        self.ids.add(post_id)
+        self.shortcodes.add(shortcode)
+        self.shortcode_collections.add((shortcode, collection))
+
+    def is_duplicate(self, p, file_type):
+        # same rules as add_new_posts:
+        # collection posts are duplicates if the post - collection pair exists
+        # non-collection posts are duplicates if the post exists anywhere
+        if file_type == "collection":
+            return (p['shortcode'], p['collection']) in self.shortcode_collections
+        return p['shortcode'] in self.shortcodes
+
+# rows handed to the driver at a time by bulk_insert_posts
+INSERT_BATCH_SIZE = 1000
+
+def bulk_insert_posts(session, posts, file_type, index):
+    """
+    Dedup an iterable of parsed posts against index and insert the survivors
+    with batched executemany core inserts. Does not commit.
+    Returns (inserted, skipped)
+    """
+    inserted, skipped = 0, 0
+    rows = []
+    for p in posts:
+        if index.is_duplicate(p, file_type):
+            skipped += 1
+            continue
+        post_id = index.ids.allocate()
+        index.add(post_id, p['shortcode'], p['collection'])
+        rows.append({
+            'id': post_id,
+            'account': p['account'],
+            'url': p['url'],
+            'shortcode': p['shortcode'],
+            'date_saved': p['date_saved'],
+            'collection': p['collection'],
+            'post_type': PostType(p['post_type']),
+        })
+        if len(rows) == INSERT_BATCH_SIZE:
+            # executemany: one compiled statement for every batch
+            session.execute(insert(Post), rows)
+            inserted += len(rows)
+            rows = []
+    if rows:
+        session.execute(insert(Post), rows)
+        inserted += len(rows)
+    return inserted, skipped
+
+def add_new_posts_bulk(session, file, force=False):
+    """
+    Same as add_new_posts but resolves duplicates and uuid collisions in memory
+    and writes everything in one transaction.
+    """
+    content_hash = known_content_hashes(session, [file]).get(file) or file_sha256(file)
+    if already_ingested(session, file, content_hash, force):
+        return 0, 0
+
+    file_type = detect_file_type(file)
+    with metrics.phase('load index'):
+        index = PostIndex(session)
+
+    # posts are parsed and inserted batch by batch as the file is read
+    inserted, skipped = 0, 0
+    for batch in metrics.timed_iter('parse', iter_takeout_file(file)):
+        with metrics.phase('insert'):
+            batch_inserted, batch_skipped = bulk_insert_posts(session, batch, file_type, index)
+        inserted += batch_inserted
+        skipped += batch_skipped
+    record_ingested_file(session, file, content_hash, inserted, skipped)
+    with metrics.phase('commit'):
+        session.commit()
+
+    metrics.count('posts inserted', inserted)
+    metrics.count('posts skipped', skipped)
+    print(f"Inserted: {inserted} | Skipped (duplicates): {skipped}")
+    return inserted, skipped
+
+def import_takeouts(session, root, workers=None, force=False, directories=None):
+    """
+    Replacement for parse.sh.
+    Parses every takeout file under root (only the given instagram-*/ directories with
+    directories) in a process pool and writes all of them
+    through this process, collection files first and then non collection files
+    (so a post saved into a collection never gets added as a non collection post first).
+    Files whose content is already in the ingested_files ledger are skipped unless force is set.
+    """
+    collection_files, non_collection_files = find_takeout_files(root, directories)
+    files = collection_files + non_collection_files
+    print(f"Found {len(collection_files)} collection files and {len(non_collection_files)} non collection files")
+    if not files:
+        return 0, 0
+
+    total_inserted, total_skipped = 0, 0
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # only parse files that are not in the ledger yet, only files that changed since
+        # (or were never seen at this path) are hashed
+        hashes = known_content_hashes(session, files)
+        unknown = [file for file in files if file not in hashes]
+        with metrics.phase('hash'):
+            hashes.update(zip(unknown, executor.map(file_sha256, unknown)))
+        new_files = []
+        seen_hashes = set()
+        for file in files:
+            if hashes[file] in seen_hashes and not force:
+                print(f"Skipping {file}, same content as another file in this import")
+                continue
+            seen_hashes.add(hashes[file])
+            if not already_ingested(session, file, hashes[file], force):
+                new_files.append(file)
+        if not new_files:
+            print("Nothing new to import")
+            return 0, 0
+
+        with metrics.phase('load index'):
+            index = PostIndex(session)
+        # results come back in submission order while the files are parsed in parallel, one file
+        # more than there are workers is in flight so a big takeout is not held in memory at once
+        # ('parse' is the time spent waiting for the workers)
+        parsed = metrics.timed_iter('parse', bounded_map(executor, parse_takeout_file, new_files, workers + 1))
+        for file, posts in zip(new_files, parsed):
+            with metrics.phase('insert'):
+                inserted, skipped = bulk_insert_posts(session, posts, detect_file_type(file), index)
+            record_ingested_file(session, file, hashes[file], inserted, skipped)
+            with metrics.phase('commit'):
+                session.commit()
+            print(f"{file} | Inserted: {inserted} | Skipped (duplicates): {skipped}")
+            total_inserted += inserted
+            total_skipped += skipped
+
+    print("="*50)
+    print(f"Total Inserted: {total_inserted} | Total Skipped (duplicates): {total_skipped}")
+    metrics.count('posts inserted', total_inserted)
+    metrics.count('posts skipped', total_skipped)
+    return total_inserted, total_skipped
+
+# how long to wait before retrying, doubled after every failed attempt
+RETRY_BASE_DELAY = {
+    ErrorClass.RATE_LIMITED: timedelta(hours=1),
+    ErrorClass.NETWORK: timedelta(minutes=10),
+    ErrorClass.HTTP: timedelta(minutes=30),
+    ErrorClass.NOT_FOUND: timedelta(days=1),
+    ErrorClass.OTHER: timedelta(hours=6),
+}
+RETRY_MAX_DELAY = timedelta(days=7)
+# give up on a post after this many failed attempts
+MAX_DOWNLOAD_ATTEMPTS = 8
+# reels go to reels/, photo and carousel posts to photos/
+DOWNLOADABLE_POST_TYPES = [PostType.REEL, PostType.POST]
+
+def count_download_backlog(session):
+    """Returns (collection, non collection, retries due) counts of posts waiting to be downloaded"""
+    has_collection = (Post.collection != None).label('has_collection')
+    rows = session.query(has_collection, func.count())\
+        .filter(
+            and_(
+                Post.is_downloaded == False,
+                Post.last_download_failed == False,
+                Post.post_type.in_(DOWNLOADABLE_POST_TYPES)
+            )
+        )\
+        .group_by(has_collection)\
+        .all()
+    counts = {bool(k): v for k, v in rows}
+    retries_due = session.query(func.count(DownloadAttempt.post_id))\
+        .join(Post, Post.id == DownloadAttempt.post_id)\
+        .filter(
+            and_(
+                DownloadAttempt.retired == False,
+                DownloadAttempt.next_eligible_at <= datetime.utcnow(),
+                Post.post_type.in_(DOWNLOADABLE_POST_TYPES)
+            )
+        )\
+        .scalar()
+    return counts.get(True, 0), counts.get(False, 0), retries_due
+
+def iter_retry_queue(session, page_size, now):
+    """Yield failed posts whose retry is due, straight from the download_attempts index"""
+    last = None
+    while True:
+        query = session.query(Post.id, Post.account, Post.url, Post.collection, Post.post_type, DownloadAttempt.next_eligible_at)\
+            .join(DownloadAttempt, DownloadAttempt.post_id == Post.id)\
+            .filter(
+                and_(
+                    DownloadAttempt.retired == False,
+                    DownloadAttempt.next_eligible_at <= now,
+                    Post.is_downloaded == False,
+                    Post.post_type.in_(DOWNLOADABLE_POST_TYPES)
+                )
+            )
+        if last is not None:
+            query = query.filter(
+                or_(
+                    DownloadAttempt.next_eligible_at > last[0],
+                    and_(DownloadAttempt.next_eligible_at == last[0], Post.id > last[1])
+                )
+            )
+        page = query.order_by(DownloadAttempt.next_eligible_at.asc(), Post.id.asc()).limit(page_size).all()
+        if not page:
+            return
+        for row in page:
+            yield row
+        last = (page[-1].next_eligible_at, page[-1].id)
+
+def iter_new_queue(session, page_size):
+    """
+    Yield posts that were never attempted, oldest first.
+    Pages are fetched with a keyset on (date_saved, id) so rows that get marked
+    downloaded/failed while the queue is being drained never shift the pages.
+    """
+    last = None
+    while True:
+        query = session.query(Post.id, Post.account, Post.url, Post.collection, Post.post_type, Post.date_saved)\
+            .filter(
+                and_(
+                    Post.is_downloaded == False,
+                    Post.last_download_failed == False,
+                    Post.post_type.in_(DOWNLOADABLE_POST_TYPES)
+                )
+            )
+        if last is not None:
+            # a row value comparison, unlike the same condition spelled with OR, seeks in ix_posts_new_queue
+            query = query.filter(tuple_(Post.date_saved, Post.id) > tuple_(*last))
+        page = query.order_by(Post.date_saved.asc(), Post.id.asc()).limit(page_size).all()
+        if not page:
+            return
+        for row in page:
+            yield row
+        last = (page[-1].date_saved, page[-1].id)
+
+def iter_download_queue(session, page_size):
+    """
+    Yield (id, account, url, collection, post_type) of posts to download:
+    failed posts whose retry is due first, then posts that were never attempted.
+    """
+    yield from iter_retry_queue(session, page_size, datetime.utcnow())
+    yield from iter_new_queue(session, page_size)
+
+def download_worker(downloader, post_id, url, is_collection, is_reel):
+    """Runs in a download thread. Never touches the db, the result is handed back to the writer"""
+    try:
+        download(url, post_id, is_collection, is_reel, downloader)
+        return None
+    except Exception as e:
+        return e
+
+def schedule_retry(previous, error_class, now):
+    """Returns (attempts, next eligible time, retired) after another failure"""
+    attempts = (previous.attempts if previous else 0) + 1
+    retired = attempts >= MAX_DOWNLOAD_ATTEMPTS
+    # a post that is not found twice in a row is gone for good (deleted / private)
+    if error_class == ErrorClass.NOT_FOUND and previous is not None and previous.last_error == ErrorClass.NOT_FOUND:
+        retired = True
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY[error_class] * 2 ** (attempts - 1))
+    return attempts, now + delay, retired
+
+@metrics.timed('save results')
+def save_download_results(session, results):
+    """
+    Write a batch of (post id, exception or None) results with a handful of statements and one commit.
+    Failures are classified and (re)scheduled in download_attempts.
+    """
+    downloaded = [post_id for post_id, error in results if error is None]
+    failed = {post_id: error for post_id, error in results if error is not None}
+    if downloaded:
+        session.execute(update(Post).where(Post.id.in_(downloaded)).values(is_downloaded=True, last_download_failed=False))
+        session.execute(delete(DownloadAttempt).where(DownloadAttempt.post_id.in_(downloaded)))
+    if failed:
+        session.execute(update(Post).where(Post.id.in_(list(failed))).values(last_download_failed=True))
+        previous_attempts = {
+            a.post_id: a for a in session.query(DownloadAttempt.post_id, DownloadAttempt.attempts, DownloadAttempt.last_error)
+                .filter(DownloadAttempt.post_id.in_(list(failed)))
+        }
+        now = datetime.utcnow()
+        rows = []
+        for post_id, error in failed.items():
+            error_class, status = classify_download_error(error)
+            error_class = ErrorClass(error_class)
+            attempts, next_eligible_at, retired = schedule_retry(previous_attempts.get(post_id), error_class, now)
+            if retired:
+                print(f"Retiring {post_id} after {attempts} attempts ({error_class.value})")
+            rows.append({
+                'post_id': post_id,
+                'attempts': attempts,
+                'last_error': error_class,
+                'last_status': status,
+                'last_message': str(error)[:500],
+                'next_eligible_at': next_eligible_at,
+                'retired': retired,
+                'updated_at': now,
+            })
+        upsert = sqlite_insert(DownloadAttempt)
+        upsert = upsert.on_conflict_do_update(
+            index_elements=[DownloadAttempt.post_id],
+            set_={column: upsert.excluded[column] for column in rows[0] if column != 'post_id'})
+        session.execute(upsert, rows)
+    session.commit()
+    results.clear()
+
+def download_new_posts(session, workers=1, limit=10, batch_size=10, rate=0.5, max_rate=2.0, chunk_size=DOWNLOAD_CHUNK_SIZE, store_root=None,
+                       media_rate=MEDIA_RATE):
+    """
+    Download posts that are not downloaded yet with a pool of download threads.
+    limit=None drains the whole queue.
+    This thread is the only one that talks to the db, results are committed every batch_size posts.
+    Requests to instagram are paced by a rate limiter starting at `rate` requests per second
+    that adapts between throttling and max_rate, media files by one of their own at media_rate.
+    With store_root set reels are kept in a content addressed MediaStore and
+    a reel whose shortcode is already stored is linked without touching the network.
+    """
+    # Print total posts remaining to be downloaded - just to get an idea
+    total_undownloaded_collection_posts, total_undownloaded_non_collection_posts, retries_due = count_download_backlog(session)
+    print("Total un-downloaded collection posts: ", total_undownloaded_collection_posts)
+    print("Total un-downloaded non-collection posts: ", total_undownloaded_non_collection_posts)
+    print("Total un-downloaded posts: ", total_undownloaded_collection_posts + total_undownloaded_non_collection_posts)
+    print("Failed posts due for a retry: ", retries_due)
+
+    batch_size = min(batch_size, SQLITE_MAX_VARIABLES)
+    queue = metrics.timed_iter('download queue', iter_download_queue(session, page_size=max(batch_size, workers * 2)))
+    if limit is not None:
+        queue = islice(queue, limit)
+        print(f"Downloading up to {limit} posts with {workers} worker(s).\n")
+    else:
+        print(f"Downloading every queued post with {workers} worker(s).\n")
+
+    downloader = make_downloader(workers, rate, max_rate, chunk_size, store_root, media_rate)
+    try:
+        done_count = run_downloads(session, downloader, queue, workers, batch_size)
+    finally:
+        downloader.close()
+
+    print(f"Done. Processed {done_count} posts.")
+    print("Rate limiter: ", downloader.limiter.stats())
+    print("Media rate limiter: ", downloader.media_limiter.stats())
+
+def make_downloader(workers=1, rate=0.5, max_rate=2.0, chunk_size=DOWNLOAD_CHUNK_SIZE, store_root=None, media_rate=MEDIA_RATE):
+    """One instaloader context, connection pool and rate limiters for a whole run. Close it when done"""
+    limiter = RateLimiter(rate=rate, max_rate=max_rate)
+    # a carousel of every worker can be fetched at once, media successes do not ramp up the API rate
+    media_limiter = RateLimiter(rate=media_rate, max_rate=media_rate, burst=workers * SIDECAR_WORKERS)
+    store = MediaStore(store_root) if store_root else None
+    return Downloader(pool_size=workers, limiter=limiter, chunk_size=chunk_size, store=store, media_limiter=media_limiter)
+
+def run_downloads(session, downloader, queue, workers=1, batch_size=10, stop=None):
+    """
+    Download the posts coming out of queue with `workers` threads sharing downloader.
+    This thread is the only one that talks to the db, results are committed every batch_size posts.
+    Once stop (a threading.Event) is set no new post is started, the running downloads finish
+    and are recorded. Returns the number of posts processed.
+    """
+    results = []
+    pending = {}
+    done_count = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        def submit(p):
+            # check if it is a collection post or a non collection post
+            # this is used to decide what folder is the reel downloaded in
+            is_collection = p.collection is not None
+            is_reel = p.post_type == PostType.REEL
+            future = executor.submit(download_worker, downloader, p.id, p.url, is_collection, is_reel)
+            pending[future] = p
+
+        try:
+            # keep a couple of posts per worker in flight so no thread sits idle
+            for p in islice(queue, workers * 2):
+                submit(p)
+
+            while pending:
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    p = pending.pop(future)
+                    error = future.result()
+                    done_count += 1
+
+                    metrics.count('downloads failed' if error is not None else 'downloads succeeded')
+                    metrics.log(f"\n===========Downloaded ({done_count})===========")
+                    metrics.log("ID: ", p.id)
+                    metrics.log("ACCOUNT: ", p.account)
+                    metrics.log("URL: ", p.url)
+                    metrics.log("COLLECTION: ", p.collection)
+                    if error is not None:
+                        metrics.log(error)
+                    metrics.log(downloader.limiter)
+                    metrics.log("=========================================\n")
+
+                    results.append((p.id, error))
+                    if len(results) >= batch_size:
+                        save_download_results(session, results)
+
+                    if stop is not None and stop.is_set():
+                        continue
+                    next_post = next(queue, None)
+                    if next_post is not None:
+                        submit(next_post)
+                if stop is not None and stop.is_set():
+                    # posts that did not start yet are cancelled below and stay queued
+                    break
+        finally:
+            # on ctrl+c (or stop) let the running downloads finish and still record everything that completed
+            for future in pending:
+                future.cancel()
+            for future, p in pending.items():
+                if not future.cancelled():
+                    results.append((p.id, future.result()))
+                    done_count += 1
+            save_download_results(session, results)
+    return done_count
+
+# ids found under Favs/, loaded for the untagged filter
+tagged_index = table('tagged_index', column('id'))
+
+def load_tagged_index(session, favs_root):
+    tagged = scan_tagged_ids(favs_root)
+    session.execute(text("CREATE TEMP TABLE IF NOT EXISTS tagged_index (id VARCHAR(4) PRIMARY KEY)"))
+    session.execute(text("DELETE FROM tagged_index"))
+    if tagged:
+        session.execute(text("INSERT OR IGNORE INTO tagged_index (id) VALUES (:id)"), [{'id': post_id} for post_id in tagged])
+    return len(tagged)
+
+def iter_playlist_entries(session, collection=None, untagged=False, shuffle=False, since=None, until=None, limit=None, page_size=500):
+    """
+    Downloaded reels matching the filters as (path, title), streamed from the ix_posts_playback index.
+    collection: None for every collection, "None" for reels that are not in a collection.
+    untagged: only reels that are not somewhere under Favs/ (needs load_tagged_index first).
+    since / until: dates, both inclusive.
+    """
+    query = select(Post.id, Post.account, Post.collection)\
+        .where(Post.post_type == PostType.REEL, Post.is_downloaded == True)
+    if collection == "None":
+        query = query.where(Post.collection == None)
+    elif collection is not None:
+        query = query.where(Post.collection == collection)
+    if since:
+        query = query.where(Post.date_saved >= datetime.combine(since, datetime.min.time()))
+    if until:
+        query = query.where(Post.date_saved < datetime.combine(until, datetime.min.time()) + timedelta(days=1))
+    if untagged:
+        query = query.where(Post.id.not_in(select(tagged_index.c.id)))
+    query = query.order_by(func.random() if shuffle else Post.date_saved.asc())
+    if limit:
+        query = query.limit(limit)
+
+    for post_id, account, post_collection in session.execute(query).yield_per(page_size):
+        path = os.path.join(MEDIA_ROOT, media_folder(post_collection is not None, True), post_id + ".mp4")
+        yield path, f"{post_collection or 'no collection'} - {account} ({post_id})"
+
+def play_videos(session, collection=None, untagged=False, shuffle=False, since=None, until=None, limit=None, playlist_path=None, launch=True, favs_root=None):
+    """
+    Write the matching reels to a playlist (m3u or xspf, by extension) and open it in vlc.
+    Without playlist_path a temporary m3u is used and removed once vlc exits.
+    """
+    if untagged:
+        favs_root = favs_root or os.path.join(MEDIA_ROOT, FAVS_FOLDER)
+        tagged_count = load_tagged_index(session, favs_root)
+        print(f"{tagged_count} reels already tagged in {favs_root}")
+
+    temporary = playlist_path is None
+    if temporary:
+        import tempfile
+        fd, playlist_path = tempfile.mkstemp(prefix='reels_', suffix='.m3u')
+        os.close(fd)
+
+    try:
+        with metrics.phase('playlist'):
+            count = write_playlist(playlist_path, iter_playlist_entries(session, collection, untagged, shuffle, since, until, limit))
+
+        print("\n\n")
+        print("="*50)
+        print(f"Playing collection \"{collection or 'all'}\" with {count} videos.")
+        print("="*50)
+        print("\n\n")
+
+        if not count:
+            print("Nothing to play.")
+        elif launch:
+            # vlc reads the playlist itself, no matter how many videos there are
+            call(["vlc", playlist_path])
+        else:
+            print(f"Playlist written to {playlist_path}")
+    finally:
+        if temporary and launch:
+            os.remove(playlist_path)
+    
+
+
+
+# share of the downloaded posts allowed to be missing their file before sync / audit stop and ask for force
+MAX_MISSING_SHARE = 0.2
+
+def media_folders_absent():
+    """True (after saying so) when none of the media folders is in the working directory"""
+    if any(os.path.isdir(folder) for folder in MEDIA_FOLDERS):
+        return False
+    # most likely not run from the folder holding reels/, do not mark everything missing
+    print("No media folders (" + ", ".join(MEDIA_FOLDERS) + ") here. Nothing changed.")
+    return True
+
+def too_many_missing(missing, downloaded, force=False):
+    """
+    True (after saying so) when so many downloaded posts are missing their file that a media folder
+    is more likely somewhere else (partly copied, on a disk that is not mounted) than the files lost.
+    """
+    if force or missing <= downloaded * MAX_MISSING_SHARE:
+        return False
+    print(f"{missing} of {downloaded} downloaded posts have no file, that looks like a missing media folder. "
+          "Nothing changed, use --force to put them back in the download queue anyway.")
+    return True
+
+def sync_download_status(session, dry_run=False, force=False):
+    """
+    Reconcile is_downloaded with what is actually on disk (sometimes files are added manually).
+    The media folders are scanned once and compared to the db with a handful of set based statements:
+    - files on disk whose row is not marked downloaded are marked downloaded
+    - rows marked downloaded whose file is missing are put back in the download queue
+    - files sitting in the wrong folder for their collection are moved to the right one
+    Nothing changes when most downloaded posts look missing, unless force is set.
+    """
+    if media_folders_absent():
+        return
+    with metrics.phase('scan'):
+        index = scan_media_folders()
+
+    session.execute(text("CREATE TEMP TABLE IF NOT EXISTS media_index (id VARCHAR(4) PRIMARY KEY, folder TEXT, size INTEGER, mtime FLOAT)"))
+    session.execute(text("DELETE FROM media_index"))
+    session.execute(
+        text("INSERT INTO media_index (id, folder, size, mtime) VALUES (:id, :folder, :size, :mtime)"),
+        [{'id': post_id, 'folder': folder, 'size': size, 'mtime': mtime} for post_id, (folder, size, mtime) in index.items()])
+
+    # files on disk that the db does not know are downloaded
+    found_ids = [row[0] for row in session.execute(text("""
+        SELECT posts.id FROM posts JOIN media_index ON media_index.id = posts.id
+        WHERE posts.is_downloaded = 0
+    """))]
+    # rows marked downloaded without a file
+    missing_ids = [row[0] for row in session.execute(text("""
+        SELECT id FROM posts
+        WHERE is_downloaded = 1 AND id NOT IN (SELECT id FROM media_index)
+    """))]
+    # files in the folder of the other kind (collection vs non collection)
+    misplaced = session.execute(text("""
+        SELECT posts.id, posts.collection, media_index.folder FROM posts
+        JOIN media_index ON media_index.id = posts.id
+    """)).all()
+    misplaced = [
+        (post_id, folder, media_folder(collection is not None, not MEDIA_FOLDERS[folder][1]))
+        for post_id, collection, folder in misplaced
+        if MEDIA_FOLDERS[folder][0] != (collection is not None)
+    ]
+    unknown_files = len(index) - session.execute(text("SELECT count(*) FROM posts JOIN media_index ON media_index.id = posts.id")).scalar()
+
+    print(f"Files found on disk: {len(index)} ({unknown_files} without a db row)")
+    print(f"Marking downloaded (file found): {len(found_ids)}")
+    print(f"Marking not downloaded (file missing): {len(missing_ids)} {missing_ids[:20]}")
+    print(f"Files in the wrong folder: {len(misplaced)}")
+
+    if dry_run:
+        session.rollback()
+        print("Dry run, nothing changed.")
+        return
+    downloaded = session.query(func.count(Post.id)).filter(Post.is_downloaded == True).scalar()
+    if too_many_missing(len(missing_ids), downloaded, force):
+        session.rollback()
+        return
+
+    session.execute(text("""
+        UPDATE posts SET is_downloaded = 1
+        WHERE is_downloaded = 0 AND id IN (SELECT id FROM media_index)
+    """))
+    session.execute(text("""
+        DELETE FROM download_attempts WHERE post_id IN (SELECT id FROM media_index)
+    """))
+    session.execute(text("""
+        UPDATE posts SET is_downloaded = 0, last_download_failed = 0
+        WHERE is_downloaded = 1 AND id NOT IN (SELECT id FROM media_index)
+    """))
+
+    for post_id, folder, correct_folder in misplaced:
+        extension = "" if MEDIA_FOLDERS[folder][1] else ".mp4"
+        source_path = os.path.join(folder, post_id + extension)
+        destination_path = os.path.join(correct_folder, post_id + extension)
+        if os.path.exists(destination_path):
+            print(f"Not moving {source_path}, {destination_path} already exists")
+            continue
+        with metrics.phase('move'):
+            os.makedirs(correct_folder, exist_ok=True)
+            os.replace(source_path, destination_path)
+        metrics.log(f"Moved {source_path} to {destination_path}")
+
+    session.execute(text("DROP TABLE media_index"))
+    session.commit()
+
+def link_duplicate(source_path, destination_paths, methods):
+    """
+    Give every destination (the file of another row of the same post) the content of
+    source_path, destinations that already exist are left alone. methods counts how.
+    Returns False if a link failed, the caller then keeps the source row (and its file)
+    so nothing is lost and the next run tries again.
+    """
+    try:
+        for destination_path in destination_paths:
+            if not os.path.exists(destination_path):
+                # a link costs no disk space or I/O no matter how big the reel is
+                with metrics.phase('link'):
+                    method = link_media(source_path, destination_path)
+                methods[method] = methods.get(method, 0) + 1
+                metrics.count(f'files linked ({method})')
+                metrics.log(f"Successfully linked ({method}) {source_path} to {destination_path}")
+    except Exception as e:
+        print(f"Error linking file: {e}")
+        return False
+    return True
+
+def merge_duplicate_posts(session, downloaded_ids, deleted_ids):
+    """
+    Db side of merging duplicate rows of a post, all in the caller's transaction:
+    downloaded_ids got their file linked, deleted_ids go with their download attempts and audit results.
+    """
+    for ids in batched(downloaded_ids, SQLITE_MAX_VARIABLES):
+        session.execute(update(Post).where(Post.id.in_(ids)).values(is_downloaded=True, last_download_failed=False))
+        session.execute(delete(DownloadAttempt).where(DownloadAttempt.post_id.in_(ids)))
+    for ids in batched(deleted_ids, SQLITE_MAX_VARIABLES):
+        session.execute(delete(DownloadAttempt).where(DownloadAttempt.post_id.in_(ids)))
+        session.execute(delete(MediaAudit).where(MediaAudit.post_id.in_(ids)))
+        session.execute(delete(Post).where(Post.id.in_(ids)))
+
+def remove_merged_files(paths):
+    """Delete the files (or photo folders) of merged rows, only once the db changes are committed"""
+    for path in paths:
+        try:
+            with metrics.phase('remove'):
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+        except FileNotFoundError:
+            # removed by hand or by an earlier run that stopped before its commit
+            metrics.log(f"Already gone: {path}")
+            continue
+        metrics.log(f"Successfully deleted: {path}")
+
+def remove_duplicates(session):
+    """
+    look for posts that exist in both non_collection and collection
+    this happens when I re tag a non-collection post into a particular collection
+    in that case I do not want to redownload the video, simply move it
+    for every post that is 
+    - in collection and in non-collection
+    
+    If found: 
+    We have 2 types of rows:
+    A: Non-collection row. This is the entry that was retagged into one or many collection rows. There should be only one of these. 
+    B: Collection row(s). The row with the same url that is now a collection row. There can be many collection rows with the same URL. 
+        e.g. same reel can belong to flirt and sociality. 
+
+
+    What do we do?
+    if A.is_downloaded == True:
+        hardlink (or reflink, or as a last resort copy) file from non_collection_reels to collection reel
+        (every file of the folder for photo posts, photos_non_collection to photos). 
+        The name of the file should be the same as B.id. 
+        Do this for every B file found that has the same URL as A. 
+        Update B.is_downloaded = True after linking successfuly. 
+        The above steps should be performed only if A.is_downloaded == True i.e. the file is downloaded. 
+        Delete the A record. 
+    Everything is read with one query and written in one commit.
+    """
+
+    # one query for every row of every post (shortcode) that is both in a collection and not in one
+    null_collection_query = select(Post.shortcode).where(Post.collection == None)
+    notnull_collection_query = select(Post.shortcode).where(Post.collection != None)
+    rows = session.query(Post.id, Post.shortcode, Post.collection, Post.post_type, Post.is_downloaded)\
+        .filter(
+            and_(
+                Post.shortcode.in_(null_collection_query),
+                Post.shortcode.in_(notnull_collection_query)
+            )
+        )\
+        .order_by(Post.shortcode)\
+        .all()
+
+    groups = {}
+    for row in rows:
+        groups.setdefault(row.shortcode, []).append(row)
+
+    deleted_ids = []
+    retagged_ids = []
+    files_to_remove = []
+    methods = {}
+    for shortcode, group in groups.items():
+        non_collection_rows = [row for row in group if row.collection is None]
+        collection_rows = [row for row in group if row.collection is not None]
+        assert len(non_collection_rows)==1, "There should be only one non-collection post while removing duplicates"
+        non_collection_row = non_collection_rows[0]
+
+        if non_collection_row.is_downloaded:
+            # reels are <id>.mp4 files, photo / carousel posts <id>/ folders
+            is_reel = non_collection_row.post_type == PostType.REEL
+            extension = ".mp4" if is_reel else ""
+            source_path = os.path.join(MEDIA_ROOT, media_folder(False, is_reel), non_collection_row.id + extension)
+            destination_folder = os.path.join(MEDIA_ROOT, media_folder(True, is_reel))
+            destination_paths = [os.path.join(destination_folder, row.id + extension) for row in collection_rows]
+            if not link_duplicate(source_path, destination_paths, methods):
+                continue
+            retagged_ids.extend(collection_row.id for collection_row in collection_rows)
+            files_to_remove.append(source_path)
+
+        deleted_ids.append(non_collection_row.id)
+
+    merge_duplicate_posts(session, retagged_ids, deleted_ids)
+    session.commit()
+    remove_merged_files(files_to_remove)
+
+    print("="*25)
+    print(f"Removed {len(deleted_ids)} non collection duplicates, {len(retagged_ids)} collection posts now downloaded {methods}")
+
+def rename_collection(session, old_name, new_name, dry_run=False):
+    """
+    Rename a collection, or merge it into another one when new_name already exists,
+    so the next takeout (which has the new name) adds nothing and downloads nothing.
+
+    A post saved in both collections would end up twice in new_name. For each of those
+    the new_name row is kept and the old_name row deleted (with its download attempts).
+    If only the old_name row was downloaded its file is linked to the kept row's id,
+    the old file is removed once everything is committed. Then every remaining
+    old_name row is renamed with a single UPDATE.
+    """
+    renamed = session.query(func.count(Post.id)).filter(Post.collection == old_name).scalar()
+    if not renamed:
+        print(f"No posts in collection {old_name!r}, nothing to rename")
+        return
+
+    # rows of posts (shortcode) saved in both collections, old and new row of a post side by side
+    kept = select(Post.id, Post.shortcode, Post.is_downloaded).where(Post.collection == new_name).subquery()
+    duplicates = session.execute(
+        select(Post.id, Post.post_type, Post.is_downloaded, kept.c.id.label('kept_id'), kept.c.is_downloaded.label('kept_is_downloaded'))
+        .join(kept, kept.c.shortcode == Post.shortcode)
+        .where(Post.collection == old_name)
+    ).all()
+
+    deleted_ids = []
+    linked_ids = []
+    files_to_remove = []
+    methods = {}
+    for row in duplicates:
+        is_reel = row.post_type == PostType.REEL
+        folder = os.path.join(MEDIA_ROOT, media_folder(True, is_reel))
+        extension = ".mp4" if is_reel else ""
+        source_path = os.path.join(folder, row.id + extension)
+        if row.is_downloaded and os.path.exists(source_path):
+            if not row.kept_is_downloaded:
+                destination_path = os.path.join(folder, row.kept_id + extension)
+                if not dry_run and not link_duplicate(source_path, [destination_path], methods):
+                    continue
+                linked_ids.append(row.kept_id)
+            files_to_remove.append(source_path)
+        deleted_ids.append(row.id)
+
+    print(f"Collection {old_name!r}: {renamed} posts | Already in {new_name!r}: {len(deleted_ids)} "
+          f"| Files linked to the kept row: {len(linked_ids)} | Files to remove: {len(files_to_remove)}")
+    if dry_run:
+        print("Dry run, nothing changed.")
+        return
+
+    merge_duplicate_posts(session, linked_ids, deleted_ids)
+    # file names only depend on the id and on being in a collection, nothing else moves
+    result = session.execute(update(Post).where(Post.collection == old_name).values(collection=new_name))
+    session.commit()
+    remove_merged_files(files_to_remove)
+
+    print("="*25)
+    print(f"Renamed {result.rowcount} posts from {old_name!r} to {new_name!r}, "
+          f"removed {len(deleted_ids)} duplicates, {len(linked_ids)} kept posts now downloaded {methods}")
+
+def store_media(session, store_root):
+    """
+    Move every downloaded reel into the content addressed media store and leave a link in its place.
+    Reels with the same shortcode and the same bytes (same reel in several collections) end up sharing one file.
+    """
+    store = MediaStore(store_root)
+    posts = session.query(Post.id, Post.url, Post.collection)\
+        .filter(
+            and_(
+                Post.is_downloaded == True,
+                Post.post_type == "REEL"
+            )
+        )
+
+    stored, deduplicated, already_stored, skipped = 0, 0, 0, 0
+    bytes_saved = 0
+    for p in posts:
+        shortcode = extract_instagram_id(p.url)
+        path = os.path.join(media_folder(p.collection is not None, True), p.id + ".mp4")
+        if not shortcode or not os.path.isfile(path):
+            skipped += 1
+            continue
+        existing_blob = store.find(shortcode)
+        if existing_blob is not None and os.path.samefile(existing_blob, path):
+            already_stored += 1
+            continue
+        size = os.path.getsize(path)
+        blob_path = store.add(shortcode, path)
+        if blob_path == existing_blob:
+            deduplicated += 1
+            bytes_saved += size
+        else:
+            stored += 1
+
+    print(f"Stored: {stored} | Deduplicated: {deduplicated} ({bytes_saved / 1024 / 1024:.1f} MiB saved) | Already stored: {already_stored} | Skipped (no file / no shortcode): {skipped}")
+
+def queue_redownload(session, reasons):
+    """
+    Put posts ({post id: reason}) back in the download queue right away: not downloaded, and due
+    in the retry queue (which is drained before never attempted posts) with the reason as the last error.
+    """
+    now = datetime.utcnow()
+    for ids in batched(reasons, SQLITE_MAX_VARIABLES):
+        session.execute(update(Post).where(Post.id.in_(ids)).values(is_downloaded=False, last_download_failed=True))
+        upsert = sqlite_insert(DownloadAttempt)
+        upsert = upsert.on_conflict_do_update(
+            index_elements=[DownloadAttempt.post_id],
+            set_={column: upsert.excluded[column] for column in ['last_error', 'last_status', 'last_message', 'next_eligible_at', 'retired', 'updated_at']})
+        session.execute(upsert, [{
+            'post_id': post_id,
+            'attempts': 0,
+            'last_error': ErrorClass.OTHER,
+            'last_status': None,
+            'last_message': reasons[post_id][:500],
+            'next_eligible_at': now,
+            'retired': False,
+            'updated_at': now,
+        } for post_id in ids])
+
+def audit_media_files(session, workers=None, with_hash=False, dry_run=False, force=False, store_root=None):
+    """
+    Check every file marked downloaded: it exists, its mp4 boxes (or jpegs) are complete and,
+    with with_hash, record its sha256. Files are checked in a process pool and the results
+    are kept in media_audits, a file whose size and mtime did not change is not read again.
+    Bad files are renamed to <name>.corrupt and their posts queued for download again,
+    posts whose file is missing are queued too (unless that is most of them, see force).
+    With store_root a bad reel that is a link into the MediaStore also gets its blob renamed,
+    otherwise the next download would link the same corrupt blob again.
+    """
+    if media_folders_absent():
+        return
+
+    posts = session.query(Post.id, Post.shortcode, Post.collection, Post.post_type).filter(Post.is_downloaded == True).all()
+    cached = {
+        row.path: row for row in session.query(MediaAudit.path, MediaAudit.size, MediaAudit.mtime, MediaAudit.problem, MediaAudit.content_hash)
+    }
+
+    paths = {}         # path -> post id
+    shortcodes = {}    # path -> shortcode
+    signatures = {}    # path -> (size, mtime)
+    missing = {}       # post id -> reason
+    bad = {}           # path -> problem
+    to_check = []
+    with metrics.phase('stat'):
+        for p in posts:
+            is_reel = p.post_type == PostType.REEL
+            path = os.path.join(media_folder(p.collection is not None, is_reel), p.id + (".mp4" if is_reel else ""))
+            paths[path] = p.id
+            shortcodes[path] = p.shortcode
+            signature = media_signature(path)
+            if signature is None:
+                missing[p.id] = "audit: file missing"
+                continue
+            signatures[path] = signature
+            previous = cached.get(path)
+            if previous is not None and (previous.size, previous.mtime) == signature and (previous.content_hash or previous.problem or not with_hash):
+                # unchanged since the last audit, a file that was bad then (dry run) still is
+                if previous.problem:
+                    bad[path] = previous.problem
+                continue
+            to_check.append(path)
+
+    print(f"Downloaded posts: {len(posts)} | Missing files: {len(missing)} | "
+          f"Unchanged since the last audit: {len(signatures) - len(to_check)} | To check: {len(to_check)}")
+    if not dry_run and too_many_missing(len(missing), len(posts), force):
+        return
+
+    with metrics.phase('check'), ProcessPoolExecutor(max_workers=workers) as executor:
+        rows = []
+        for path, problem, content_hash in executor.map(audit_media, to_check, [with_hash] * len(to_check), chunksize=64):
+            size, mtime = signatures[path]
+            rows.append({'path': path, 'post_id': paths[path], 'size': size, 'mtime': mtime,
+                         'problem': problem, 'content_hash': content_hash, 'audited_at': datetime.utcnow()})
+            if problem:
+                bad[path] = problem
+                metrics.log(f"{path}: {problem}")
+            if len(rows) >= 500:
+                save_media_audits(session, rows)
+        save_media_audits(session, rows)
+    metrics.count('files checked', len(to_check))
+
+    print(f"Checked: {len(to_check)} | Bad files: {len(bad)}")
+    for path, problem in list(bad.items())[:20]:
+        print(f"  {path}: {problem}")
+
+    if dry_run:
+        # the audit results are kept, the next run does not need to read these files again
+        session.commit()
+        print("Dry run, nothing renamed or queued.")
+        return
+
+    store = MediaStore(store_root) if store_root else None
+    quarantined = 0
+    reasons = dict(missing)
+    for path, problem in bad.items():
+        # keep the bytes around for a look, the .corrupt name keeps the file out of every scan
+        with metrics.phase('rename'):
+            if store is not None and shortcodes[path] and os.path.isfile(path):
+                quarantined += len(store.quarantine(shortcodes[path], path))
+            os.replace(path, path + ".corrupt")
+        reasons[paths[path]] = f"audit: {problem}"
+    queue_redownload(session, reasons)
+
+    # results for files that are not there anymore (renamed, moved, deleted) are of no use
+    gone = list(bad) + [path for path in cached if path not in signatures]
+    for chunk in batched(gone, SQLITE_MAX_VARIABLES):
+        session.execute(delete(MediaAudit).where(MediaAudit.path.in_(chunk)))
+    session.commit()
+    metrics.count('posts queued again', len(reasons))
+    print(f"Renamed to .corrupt: {len(bad)} (media store blobs: {quarantined}) | Queued for download again: {len(reasons)}")
+
+def save_media_audits(session, rows):
+    if not rows:
+        return
+    upsert = sqlite_insert(MediaAudit)
+    upsert = upsert.on_conflict_do_update(
+        index_elements=[MediaAudit.path],
+        set_={column: upsert.excluded[column] for column in rows[0] if column != 'path'})
+    session.execute(upsert, rows)
+    rows.clear()
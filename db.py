@@ -1,462 +1,349 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, ForeignKey, Boolean, Enum, and_, or_, select
-import enum
-from sqlalchemy.orm import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+"""
+Command line entry point: python db.py <action> [options]
 
-from datetime import datetime
-import json
-import shortuuid
-from random import randint
-from time import sleep
+Heavy dependencies (SQLAlchemy, instaloader, requests, pyperclip) are only imported
+by the commands that need them, read only lookups go straight to sqlite3.
+The models live in models.py and the commands in commands.py.
+"""
 import argparse
-from subprocess import call
+import json
 import os
-import shutil
-import pyperclip
-
-from utils import *
-
-# Define enum classes
-class PostType(enum.Enum):
-    POST = 'post'
-    REEL = 'reel'
-    TV = 'tv'
-    OTHER = 'other'
-
-# Create the base class for declarative models
-Base = declarative_base()
-
-# Define example models
-class Post(Base):
-    __tablename__ = 'posts'
-
-    id = Column(String(4), primary_key=True)
-    account = Column(String(50), unique=False)
-    url = Column(String(120), unique=False)
-    date_saved = Column(DateTime)
-    collection = Column(String(50))
-    post_type = Column(Enum(PostType))
-    created_at = Column(DateTime, default=datetime.utcnow)
-    is_downloaded = Column(Boolean, default=False)
-    last_download_failed = Column(Boolean, default=False)
-    
-
-    def __repr__(self):
-        return f"<Post id:{self.id}, | account:{self.account}, | collection: {self.collection}, | url: {self.url}, | Downloaded: {self.is_downloaded}>"
-
-
-
-def init_db():
-    """Initialize the database, create tables"""
-    # Create SQLite database engine
-    # Use ':memory:' for in-memory database, or 'sqlite:///your_db.sqlite' for file-based
-    engine = create_engine('sqlite:///reels.sqlite', echo=True)
-    
-    # Create all tables
-    Base.metadata.create_all(engine)
-    
-    # Create session factory
-    Session = sessionmaker(bind=engine)
-    
-    return Session()
-
-def get_session():
-    """Creates a session attached to an existing sqlite file based db"""
-    # Create SQLite database engine
-    engine = create_engine('sqlite:///reels.sqlite')
-
-    # Create session factory
-    Session = sessionmaker(bind=engine)
-
-    print("Connected to existing database, \"reels.sqlite\"")
-
-    return engine, Session()
-
-
-def add_new_posts(session, file):
-
-    # open the takout file
-    with open(file) as f:
-        new_saved_posts_raw = json.load(f)
-
-    file_type = detect_file_type(file)
-    
-    if file_type == "collection":
-        # convert takeout from insta format to a dictionary of collections
-        new_saved_posts = parse_saved_posts(new_saved_posts_raw)
-    elif file_type == "non_collection":
-        # it is a list of posts that do not belong to a collection
-        new_saved_posts = parse_non_collection_saved_posts(new_saved_posts_raw)
-    
-
-    if file_type == "collection":
-        # for each post check
-        # - same uuid doesn't already exist
-        # - the same post url - collection combination does not exist
-        # (same post can exist multiple times but with different collection)
-        for collection_name in new_saved_posts.keys():
-            for p in new_saved_posts[collection_name]:
-                assert collection_name == p['collection']
-                # check uuid collision
-                # query all rows with the same uuid
-                # if found, keep assigning new uuids until no row is found with the same uuid
-                post_uuid = p['id']
-                posts_with_same_uuid = session.query(Post).filter(Post.id==post_uuid).count()
-                while posts_with_same_uuid > 0:
-                    print(f"UUID Collision Detected for id [{post_uuid}]. \n Assigning new UUID")
-                    post_uuid = shortuuid.ShortUUID().random(length=4)
-                    posts_with_same_uuid = session.query(Post).filter(Post.id==post_uuid).count()
+import pathlib
+import sqlite3
+import sys
+from datetime import date
 
-                # look for another row with the same post url - collection pair
-                duplicate_entry_count = session.query(Post)\
-                    .filter(
-                        and_(
-                            Post.url == p['url'],
-                            Post.collection == p['collection']
-                        )
-                    )\
-                    .count()
-                if duplicate_entry_count > 0:
-                    # print("Post Being Skipped: ", p)
-                    continue
+import metrics
+from utils import DB_PATH, SQLITE_PROFILES, DOWNLOAD_CHUNK_SIZE, MEDIA_RATE, PLAYLIST_WRITERS, SQLITE_MAX_VARIABLES, batched
 
-                new_post = Post(
-                    id=post_uuid,
-                    account=p['account'],
-                    url=p['url'],
-                    date_saved=p['date_saved'],
-                    collection=p['collection'],
-                    post_type=PostType(p['post_type']))
-                
-                print(new_post)
-                session.add(new_post)
-        session.commit()
-    elif file_type == "non_collection":
-        # for each post check
-        # - same uuid doesn't already exist
-        # - same url doesn't already exist
-        for p in new_saved_posts:
-            # check uuid collision
-            # query all rows with the same uuid
-            # if found, keep assigning new uuids until no row is found with the same uuid
-            post_uuid = p['id']
-            posts_with_same_uuid = session.query(Post).filter(Post.id==post_uuid).count()
-            while posts_with_same_uuid > 0:
-                print(f"UUID Collision Detected for id [{post_uuid}]. \n Assigning new UUID")
-                post_uuid = shortuuid.ShortUUID().random(length=4)
-                posts_with_same_uuid = session.query(Post).filter(Post.id==post_uuid).count()
+# action -> argument(s) it cannot run without, one of them is enough
+REQUIRED_ARGUMENTS = {
+    'add-new-posts': ('file',),
+    'store-media': ('store',),
+    'find-link': ('id', 'dir'),
+    'restore-backup': ('file',),
+}
 
-            # query all the rows for the same url 
-            # if found skip it because 
-            # if it is a pre-existing collection row then it has no business beng a non-collection row
-            # if it is a pre-existing non-collection row then it will lead to duplication
-            # insta is sending bad quality data
-            post_url = p['url']
-            posts_with_same_url = session.query(Post).filter(Post.url==post_url).all()
-            if len(posts_with_same_url) > 0:
-                print(f"Skipping. Existing post(s) IDs: ")
-                [print(f"ID: {duplicate_post.id} | account: {duplicate_post.account}") for duplicate_post in posts_with_same_url]
-                print("X"*50)
-                continue
 
-            new_post = Post(
-                id=post_uuid,
-                account=p['account'],
-                url=p['url'],
-                date_saved=p['date_saved'],
-                collection=p['collection'],
-                post_type=PostType(p['post_type']))
-            
-            print(new_post)
-            session.add(new_post)
-        session.commit()
+def __getattr__(name):
+    # `import db; db.add_new_posts(...)` keeps working, the ORM is only loaded on first use
+    import commands
+    return getattr(commands, name)
 
-    # confirm non collission hash
-    # add to db
 
-def download_new_posts(session):
-    # Print total posts remaining to be downloaded - just to get an idea
-    total_undownloaded_collection_posts = session.query(Post)\
-        .filter(
-            and_(
-                Post.is_downloaded == False,
-                Post.last_download_failed == False,
-                Post.post_type == "REEL",
-                Post.collection != None
-            )
-        ).count()
-    total_undownloaded_non_collection_posts = session.query(Post)\
-        .filter(
-            and_(
-                Post.is_downloaded == False,
-                Post.last_download_failed == False,
-                Post.post_type == "REEL",
-                Post.collection == None
-            )
-        ).count()
-    print("Total un-downloaded collection posts: ", total_undownloaded_collection_posts)
-    print("Total un-downloaded non-collection posts: ", total_undownloaded_non_collection_posts)
-    print("Total un-downloaded posts: ", total_undownloaded_collection_posts + total_undownloaded_non_collection_posts)
+def connect_readonly(db_path):
+    """Plain sqlite3 connection for lookups, no SQLAlchemy and no migrations"""
+    return sqlite3.connect(pathlib.Path(db_path).absolute().as_uri() + "?mode=ro", uri=True)
 
 
-
-    # query posts where is_downloaded is 0 and last_download_failed is 0
-    posts = session.query(Post)\
-        .filter(
-            and_(
-                Post.is_downloaded == False,
-                Post.last_download_failed == False,
-                Post.post_type == "REEL"
-            )
-        )\
-        .order_by(Post.date_saved.asc())\
-        .limit(10)
-    
-    post_count = len(posts.all()) # this is inefficient and should not be done for long queries
-    print(f"Found {post_count} posts to download.\n")
-
-    # pick 5 posts download them with wait timer of 5
-    for idx, p in enumerate(posts):
-        print(f"\n===========Downloading ({idx+1}/{post_count})===========")
-        print("ID: ", p.id)
-        print("ACCOUNT: ", p.account)
-        print("URL: ", p.url)
-        print("COLLECTION: ", p.collection)
-        print(">>-<<")
-
-        # check if it is a collection post or a non collection post
-        # this is used to decide what folder is the reel downloaded in
-        is_collection = p.collection is not None
-        is_reel = p.post_type == PostType.REEL
-        try:
-            download(p.url, p.id, is_collection, is_reel)
-            p.is_downloaded = True
-        except Exception as e:
-            p.last_download_failed = True
-            print(e)
-        session.commit()
-
-        print("=========================================\n")
-
-        # Add a random wait time
-        random_waiting_time = randint(10,15)
-        print(f"Waiting for {random_waiting_time/60} minutes...")
-        #sleep(random_waiting_time)
-        print("Waiting over.")
-
-def play_videos(collection=None):
-
-    collection = None if collection == "None" else collection # figure out a cleaner way to do this
-    collection = "flirt"
-
-    posts = session.query(Post)\
-        .filter(
-            and_(
-                Post.is_downloaded == True,
-                Post.post_type == "REEL",
-                Post.collection == collection
-            )
-        )\
-        .order_by(Post.date_saved.asc())
-
-    # which folder to fetch the files from
-    if collection and collection.lower() != "None":
-        folder_prefix = "/home/namit/Downloads/ig_saved/reels/"
+def find_link(db_path, id):
+    """
+    Given a post ID, return the instagram URL of the post 
+    """
+    conn = connect_readonly(db_path)
+    try:
+        row = conn.execute("SELECT url FROM posts WHERE id = ?", (id,)).fetchone()
+    finally:
+        conn.close()
+    if row:
+        print(row[0])
+        import pyperclip
+        pyperclip.copy(row[0])
+        print("Copied to clipboard!")
     else:
-        folder_prefix = "/home/namit/Downloads/ig_saved/reels_non_collection/"
-
-    post_list = []
-    for p in posts:
-        post_address = folder_prefix + p.id + ".mp4"
-        post_list.append(post_address)
-
-    print("\n\n")
-    print("="*50)
-    print(f"Playing collection \"{collection}\" with {len(post_list)} videos.")
-    print("="*50)
-    print("\n\n")
-
-    # launch vlc with the list of posts
-    call(["vlc"] + post_list)
-    
-
-
+        print(f"No post found with id: {id}")
 
-def sync_download_status(session):
-    # query all posts where is_downloaded is False 
-    # and check if that file exists
-    # sometimes files are added manually
-    posts = session.query(Post).filter(Post.is_downloaded==False)
 
-    for p in posts:
-        if file_exists(p.id):
-            p.is_downloaded = True
-            print("updating: ", p)
-    
-    session.commit()
+LOOKUP_FIELDS = ['id', 'url', 'account', 'collection', 'downloaded', 'download_state']
 
-def remove_duplicates(session):
+def read_lookup_ids(ids, directory=None):
     """
-    look for posts that exist in both non_collection and collection
-    this happens when I re tag a non-collection post into a particular collection
-    in that case I do not want to redownload the video, simply move it
-    for every post that is 
-    - in collection and in non-collection
-    
-    If found: 
-    We have 2 types of rows:
-    A: Non-collection row. This is the entry that was retagged into one or many collection rows. There should be only one of these. 
-    B: Collection row(s). The row with the same url that is now a collection row. There can be many collection rows with the same URL. 
-        e.g. same reel can belong to flirt and sociality. 
-
-
-    What do we do?
-    if A.is_downloaded == True:
-        copy file from non_collection_reels to collection reel. 
-        The name of the file should be the same as B.id. 
-        Do this for every B file found that has the same URL as A. 
-        Update B.is_downloaded = True after copying successfuly. 
-        The above steps should be performed only if A.is_downloaded == True i.e. the file is downloaded. 
-        Delete the A record. 
+    Ids given on the command line ("-" reads whitespace separated ids from stdin)
+    and the <id>.mp4 files / <id> photo folders in directory. Duplicates are dropped, order is kept.
     """
-
-    # Subquery to find URLs with NULL collections
-    # Create proper select statements for subqueries
-    null_collection_query = select(Post.url).where(Post.collection == None)
-    notnull_collection_query = select(Post.url).where(Post.collection != None)
-    
-    # Find URLs that exist in both queries using EXISTS
-    result = session.query(Post.url).distinct().filter(
-        and_(
-            Post.url.in_(null_collection_query),
-            Post.url.in_(notnull_collection_query)
-        )
-    ).all()
-    
-    # Extract URLs from result tuples
-    urls = [r[0] for r in result]
-
-    for i in urls:
-        non_collection_rows = session.query(Post).filter(
-                and_(
-                    Post.url == i,
-                    Post.collection == None
-                )
-            ).all()
-        assert len(non_collection_rows)==1, "There should be only one non-collection post while removing duplicates"
-
-        non_collection_id = non_collection_rows[0].id
-        non_collection_is_downloaded = non_collection_rows[0].is_downloaded
-        non_collection_last_download_failed = non_collection_rows[0].last_download_failed
-
-        collection_rows = session.query(Post).filter(
-                and_(
-                    Post.url == i,
-                    Post.collection != None
-                )
-            ).all()
-        
-        for collection_row in collection_rows:
-            if non_collection_is_downloaded:
-                # copy file
-                source_folder = "/home/namit/Downloads/ig_saved/reels_non_collection"
-                destination_folder = "/home/namit/Downloads/ig_saved/reels"
-                source_file = non_collection_id + ".mp4"
-                destination_file = collection_row.id + ".mp4"
-                source_path = os.path.join(source_folder, source_file)
-                destination_path = os.path.join(destination_folder, destination_file)
-                
-                
-                # Copy the file
-                try:
-                    shutil.copy2(source_path, destination_path)
-                    print(f"Successfully copied {source_path} to {destination_path}")
-                except Exception as e:
-                    print(f"Error copying file: {e}")
-                    return False
-
-                # copy is downloaded status
-                collection_row.is_downloaded = non_collection_is_downloaded
-                collection_row.last_download_failed = non_collection_last_download_failed
-
-        # delete non_collection video file only when everything happened successfully
-        os.remove(source_path)
-        print(f"Successfully deleted: {source_path}")
-
-        # delete non_collection_row
-        session.delete(non_collection_rows[0])
-        print(f"Successfully deleted: {non_collection_rows[0]}")
-        session.commit()
-
-
-        print("="*25)
-
-def find_link(session, id):
+    found = []
+    for id in ids or []:
+        found.extend(sys.stdin.read().split() if id == '-' else [id])
+    if directory:
+        with os.scandir(directory) as entries:
+            for entry in sorted(entries, key=lambda entry: entry.name):
+                if entry.name.endswith('.mp4'):
+                    found.append(entry.name[:-len('.mp4')])
+                elif entry.is_dir() and not entry.name.endswith('.part'):
+                    found.append(entry.name)
+    return list(dict.fromkeys(found))
+
+
+def lookup_posts(db_path, ids):
     """
-    Given a post ID, return the instagram URL of the post 
+    Resolve many ids with one IN (...) query per SQLITE_MAX_VARIABLES ids.
+    Returns {id: row dict} for the ids that exist.
     """
-    result = session.query(Post).filter(Post.id==id).first()
-    if result:
-        print(result.url)
-        pyperclip.copy(result.url)
-        print("Copied to clipboard!")
-    else:
-        print(f"No post found with id: {id}")
+    conn = connect_readonly(db_path)
+    try:
+        has_attempts = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'download_attempts'").fetchone()
+        # older databases have no retry queue yet, only the failed flag
+        attempts_join = "LEFT JOIN download_attempts a ON a.post_id = p.id" if has_attempts else ""
+        retired = "a.retired" if has_attempts else "NULL"
+        attempted = "a.post_id IS NOT NULL" if has_attempts else "p.last_download_failed"
+        rows = {}
+        for chunk in batched(ids, SQLITE_MAX_VARIABLES):
+            query = f"""
+                SELECT p.id, p.url, p.account, p.collection, p.is_downloaded,
+                       CASE WHEN p.is_downloaded THEN 'downloaded'
+                            WHEN {retired} THEN 'retired'
+                            WHEN {attempted} THEN 'retrying'
+                            ELSE 'queued' END
+                FROM posts p {attempts_join}
+                WHERE p.id IN ({', '.join('?' * len(chunk))})
+            """
+            for row in conn.execute(query, chunk):
+                rows[row[0]] = dict(zip(LOOKUP_FIELDS, row))
+                rows[row[0]]['downloaded'] = bool(row[4])
+    finally:
+        conn.close()
+    return rows
 
 
-if __name__ == '__main__':
-    # Initialize database and get session 
-    # (only run first time when setting up the db)
-    # session = init_db()
-
-    # Connect to an existing sqlite db
-    engine, session = get_session()
+def find_links(db_path, ids, output_format='tsv'):
+    """Print url, account, collection and download state of every id as tsv or json, unknown ids included"""
+    rows = lookup_posts(db_path, ids)
+    results = [rows.get(id, dict.fromkeys(LOOKUP_FIELDS, None) | {'id': id, 'download_state': 'unknown'}) for id in ids]
+    if output_format == 'json':
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        print("\t".join(LOOKUP_FIELDS))
+        for result in results:
+            print("\t".join('' if result[field] is None else str(result[field]) for field in LOOKUP_FIELDS))
+    print(f"{len(rows)} of {len(ids)} ids found", file=sys.stderr)
 
 
+def build_parser():
     parser = argparse.ArgumentParser(description='Instagram Post Management Tool')
     # add a command line positional argument called action
     # action can have only 3 valid values
     parser.add_argument('action', 
-                        choices=['download', 'sync-download-status', 'add-new-posts', 'play', 'remove-duplicates', 'find-link'],
+                        choices=['download', 'sync-download-status', 'add-new-posts', 'import-takeouts', 'play', 'remove-duplicates', 'store-media', 'find-link', 'backup', 'restore-backup', 'audit', 'rename-collection', 'watch'],
                         help='Action to execute: \
                               download (download new posts), \
                               sync-download-status (sync downloaded status for manually downloaded posts), \
                               add-new-posts (add new posts from the instagram takeout file)\
-                              play (play downloaded videos from a particular collection, "None" for no collection),\
+                              import-takeouts (add new posts from every takeout directory under --root)\
+                              play (play downloaded videos from a particular collection, "None" for no collection, through a playlist),\
                               remove-duplicates (remove reels that exist in both collection and non-collection),\
-                              find-link (print IG URL for a given 4 charachter post ID)')
+                              store-media (move downloaded reels into the --store media store and link them back),\
+                              find-link (print IG URL for a given 4 charachter post ID),\
+                              backup (online backup of the database into --backup-dir, --incremental for changed rows only),\
+                              restore-backup (rebuild the backup given with --file into --db),\
+                              audit (check every downloaded file, queue corrupt or missing ones for download again),\
+                              rename-collection (rename the --from collection to --to, merging it if --to exists),\
+                              watch (keep running: import new takeouts from --root as they appear and download the queue)')
     # Add file path argument for add-new-posts command
     parser.add_argument('--file', type=str,
                       help='Path to the JSON file (required for add-posts command)')
+    parser.add_argument('--bulk', action='store_true',
+                      help='add-new-posts: dedup in memory and insert everything in one batched transaction')
+    # Add takeout folder argument for import-takeouts command
+    parser.add_argument('--root', type=str, default='takeout_files',
+                      help='Folder containing the instagram-*/ takeout directories (import-takeouts, watch)')
+    parser.add_argument('--force', action='store_true',
+                      help='add-new-posts / import-takeouts: add files even if the ingested_files ledger says they were already added, \
+                            sync-download-status / audit: queue missing files even when most of them are missing')
+    parser.add_argument('--workers', type=int, default=None,
+                      help='Number of worker processes used to parse takeout files (import-takeouts) \
+                            or check media files (audit), or download threads (download, watch, defaults to 1)')
+    # Add download queue arguments
+    parser.add_argument('--limit', type=int, default=None,
+                      help='Maximum number of posts to download in this run, 10 by default (download), \
+                            between two looks for new takeouts, 100 by default (watch) \
+                            or to put in the playlist (play)')
+    parser.add_argument('--all', action='store_true',
+                      help='Keep downloading until the queue is empty, ignores --limit (download)')
+    parser.add_argument('--batch-size', type=int, default=10,
+                      help='Number of download results committed together (download, watch)')
+    parser.add_argument('--rate', type=float, default=0.5,
+                      help='Starting number of instagram requests per second, adapts while running (download, watch)')
+    parser.add_argument('--max-rate', type=float, default=2.0,
+                      help='Upper bound for the adaptive request rate (download, watch)')
+    parser.add_argument('--media-rate', type=float, default=MEDIA_RATE,
+                      help='Media file requests per second, they have their own limiter (download, watch)')
+    parser.add_argument('--chunk-size', type=int, default=DOWNLOAD_CHUNK_SIZE,
+                      help='Bytes written to disk at a time while downloading (download, watch)')
+    parser.add_argument('--store', type=str, default=None,
+                      help='Content addressed media store folder, reels are stored once per shortcode and linked (download, watch, store-media), \
+                            corrupt blobs are renamed too (audit)')
+    # Add watch arguments
+    parser.add_argument('--poll-interval', type=float, default=60,
+                      help='Seconds between looks at the download queue when it is empty, and at --root without inotify (watch)')
+    parser.add_argument('--settle', type=float, default=10,
+                      help='Seconds a new takeout directory must stay unchanged before it is imported (watch)')
+    # Add collection names to rename-collection command
+    parser.add_argument('--from', dest='from_collection', type=str,
+                      help='Collection to rename (rename-collection)')
+    parser.add_argument('--to', dest='to_collection', type=str,
+                      help='New name of the collection, posts already in it are merged (rename-collection)')
     # Add collection name to play command
     parser.add_argument('--collection_name', type=str,
-                      help='Name of the collection whose videos you want to play (required for the play command)')
+                      help='Name of the collection whose videos you want to play, "None" for reels without a collection, all reels when left out (play)')
+    parser.add_argument('--untagged', action='store_true',
+                      help='Only play reels that are not sorted into the Favs folder yet (play)')
+    parser.add_argument('--shuffle', action='store_true',
+                      help='Play in random order instead of by date saved (play)')
+    parser.add_argument('--since', type=date.fromisoformat, default=None,
+                      help='Only play reels saved on or after this YYYY-MM-DD date (play)')
+    parser.add_argument('--until', type=date.fromisoformat, default=None,
+                      help='Only play reels saved on or before this YYYY-MM-DD date (play)')
+    parser.add_argument('--playlist', type=str, default=None,
+                      help='Write the playlist to this .m3u/.m3u8/.xspf file instead of a temporary one (play)')
+    parser.add_argument('--dry-run', action='store_true',
+                      help='Only report what would change (sync-download-status, audit, rename-collection), write the playlist without starting vlc (play)')
+    parser.add_argument('--hash', action='store_true',
+                      help='Also record the sha256 of every audited file (audit)')
     # Add post ID argument for the find_link argument
-    parser.add_argument('--id', type=str,
-                      help='4 charachter ID used to identify a post in the database')
-    args = parser.parse_args()
+    parser.add_argument('--id', type=str, nargs='+',
+                      help='4 charachter ID(s) used to identify a post in the database, "-" reads them from stdin (find-link)')
+    parser.add_argument('--dir', type=str, default=None,
+                      help='Look up every <id>.mp4 file / <id> folder in this folder (find-link)')
+    parser.add_argument('--format', choices=['tsv', 'json'], default=None,
+                      help='Output of a batch lookup, tsv by default (find-link)')
+    # Add backup arguments
+    parser.add_argument('--incremental', action='store_true',
+                      help='Only store the rows changed since the newest full backup (backup)')
+    parser.add_argument('--backup-dir', type=str, default='DB Backups',
+                      help='Folder the backups are written to (backup)')
+    parser.add_argument('--keep', type=int, default=5,
+                      help='Number of full and of incremental backups kept, older ones are removed, 0 keeps everything (backup)')
+    parser.add_argument('--pages', type=int, default=100,
+                      help='Database pages copied per step of a full backup (backup)')
+    parser.add_argument('--pause', type=float, default=0.01,
+                      help='Seconds to wait between backup steps so writers get a turn (backup)')
+    # Database options shared by every command
+    parser.add_argument('--db', type=str, default=DB_PATH,
+                      help='Path to the sqlite database')
+    parser.add_argument('--sqlite-profile', choices=list(SQLITE_PROFILES), default='performance',
+                      help='Set of sqlite PRAGMAs used for every connection (performance enables WAL)')
+    # Instrumentation shared by every command
+    parser.add_argument('--profile', action='store_true',
+                      help='Print time per phase, SQL statement counts and download throughput when the command ends')
+    parser.add_argument('--metrics-out', type=str, default=None,
+                      help='Write the same numbers (and every download) as JSON to this file when the command ends')
+    parser.add_argument('--quiet', action='store_true',
+                      help='Do not print a line for every post added / downloaded / moved, only totals')
+    return parser
+
+
+def run_command(args):
+    """Commands that need the ORM"""
+    import commands
+
+    # Initialize database and get session 
+    # (only run first time when setting up the db)
+    # session = commands.init_db()
+
+    # Connect to an existing sqlite db
+    engine, session = commands.get_session(args.db, args.sqlite_profile)
+    if metrics.enabled:
+        metrics.watch_engine(engine)
 
     try:
         # Execute the requested command
         if args.action == 'download':
-            download_new_posts(session)
+            commands.download_new_posts(session,
+                                        workers=args.workers or 1,
+                                        limit=None if args.all else (10 if args.limit is None else args.limit),
+                                        batch_size=args.batch_size,
+                                        rate=args.rate,
+                                        max_rate=args.max_rate,
+                                        chunk_size=args.chunk_size,
+                                        store_root=args.store,
+                                        media_rate=args.media_rate)
         elif args.action == 'sync-download-status':
-            sync_download_status(session)
+            commands.sync_download_status(session, args.dry_run, args.force)
         elif args.action == 'add-new-posts':
-            if not args.file:
-                parser.error("sync-posts command requires --file argument")
-            add_new_posts(session, args.file)
+            if args.bulk:
+                commands.add_new_posts_bulk(session, args.file, args.force)
+            else:
+                commands.add_new_posts(session, args.file, args.force)
+        elif args.action == 'import-takeouts':
+            commands.import_takeouts(session, args.root, args.workers, args.force)
         elif args.action == 'play':
-            if not args.collection_name:
-                parser.error("play command requires --collection_name argument")
-            play_videos(args.collection_name)
+            commands.play_videos(session,
+                                 collection=args.collection_name,
+                                 untagged=args.untagged,
+                                 shuffle=args.shuffle,
+                                 since=args.since,
+                                 until=args.until,
+                                 limit=args.limit,
+                                 playlist_path=args.playlist,
+                                 launch=not args.dry_run)
         elif args.action == 'remove-duplicates':
-            remove_duplicates(session)
-        elif args.action == 'find-link':
-            if not args.id:
-                parser.error("find-link command requires --id argument")
-            find_link(session, args.id)
+            commands.remove_duplicates(session)
+        elif args.action == 'store-media':
+            commands.store_media(session, args.store)
+        elif args.action == 'audit':
+            commands.audit_media_files(session, args.workers, args.hash, args.dry_run, args.force, args.store)
+        elif args.action == 'rename-collection':
+            commands.rename_collection(session, args.from_collection, args.to_collection, args.dry_run)
+        elif args.action == 'watch':
+            import watch
+            watch.watch(session, args.root,
+                        workers=args.workers or 1,
+                        batch_size=args.batch_size,
+                        rate=args.rate,
+                        max_rate=args.max_rate,
+                        chunk_size=args.chunk_size,
+                        store_root=args.store,
+                        pass_size=args.limit or watch.PASS_SIZE,
+                        poll_interval=args.poll_interval,
+                        settle=args.settle,
+                        media_rate=args.media_rate)
     finally:
         # Clean up
         session.close()
         engine.dispose()
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    required = REQUIRED_ARGUMENTS.get(args.action)
+    if required and not any(getattr(args, argument) for argument in required):
+        parser.error(f"{args.action} command requires --" + " or --".join(required) + " argument")
+    if args.action == 'rename-collection':
+        if not args.from_collection or not args.to_collection:
+            parser.error("rename-collection command requires --from and --to arguments")
+        if "None" in (args.from_collection, args.to_collection) or args.from_collection == args.to_collection:
+            parser.error("--from and --to must be two different collection names (use remove-duplicates for posts without a collection)")
+    if args.playlist and pathlib.Path(args.playlist).suffix.lower() not in PLAYLIST_WRITERS:
+        parser.error(f"--playlist must end in one of {', '.join(PLAYLIST_WRITERS)}")
+
+    metrics.enable(collect=args.profile or bool(args.metrics_out), print_items=not args.quiet)
+    try:
+        if args.action == 'find-link':
+            # primary key lookups, not worth loading SQLAlchemy for
+            ids = read_lookup_ids(args.id, args.dir)
+            if len(ids) == 1 and not args.dir and not args.format and args.id != ['-']:
+                find_link(args.db, ids[0])
+            else:
+                find_links(args.db, ids, args.format or 'tsv')
+        elif args.action == 'backup':
+            import backup
+            backup.backup(args.db, args.backup_dir, args.incremental, args.keep, args.pages, args.pause)
+        elif args.action == 'restore-backup':
+            import backup
+            backup.restore_backup(args.file, args.db)
+        else:
+            run_command(args)
+    finally:
+        # also after ctrl+c or a crash, a slow run that was cut short is the one worth looking at
+        if args.profile:
+            metrics.print_summary(args.action)
+        if args.metrics_out:
+            metrics.write(args.metrics_out, args.action)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+"""
+Lightweight instrumentation shared by every command.
+
+Hot paths are wrapped in phase("name") blocks, SQL statements are counted through
+engine events and downloads record their size and duration. Nothing is collected
+unless enable() was called (db.py does for --profile / --metrics-out), and per item
+output goes through log() so it can be switched off with --quiet on big runs.
+"""
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+enabled = False
+verbose = True
+
+_lock = threading.Lock()
+_started = time.perf_counter()
+_started_at = datetime.now()
+# name -> [count, total seconds, max seconds]
+_phases = {}
+_counters = {}
+# statement kind (SELECT, INSERT, ...) -> [count, total seconds]
+_sql = {}
+_downloads = []
+
+
+def enable(collect=True, print_items=True):
+    global enabled, verbose, _started, _started_at
+    enabled = collect
+    verbose = print_items
+    _started = time.perf_counter()
+    _started_at = datetime.now()
+
+
+def log(*args, **kwargs):
+    """print() for per item output (every post added, every download), silent with --quiet"""
+    if verbose:
+        print(*args, **kwargs)
+
+
+def add_time(name, seconds, count=1):
+    if not enabled:
+        return
+    with _lock:
+        phase = _phases.setdefault(name, [0, 0.0, 0.0])
+        phase[0] += count
+        phase[1] += seconds
+        phase[2] = max(phase[2], seconds)
+
+
+@contextmanager
+def phase(name):
+    """Time a block of code, nested and concurrent (per thread) phases are fine"""
+    if not enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(name, time.perf_counter() - start)
+
+
+def timed(name):
+    """Decorator version of phase()"""
+    def decorator(function):
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return function(*args, **kwargs)
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        return wrapper
+    return decorator
+
+
+def timed_iter(name, iterable):
+    """Yield from iterable, timing only the time spent producing each item (e.g. parsing)"""
+    if not enabled:
+        yield from iterable
+        return
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            add_time(name, time.perf_counter() - start, count=0)
+            return
+        add_time(name, time.perf_counter() - start)
+        yield item
+
+
+def count(name, n=1):
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def record_download(path, size, seconds):
+    if not enabled:
+        return
+    with _lock:
+        _downloads.append((path, size, seconds))
+
+
+def watch_engine(engine):
+    """Count and time every SQL statement run through engine"""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info['metrics_start'].pop()
+        kind = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'OTHER'
+        with _lock:
+            sql = _sql.setdefault(kind, [0, 0.0])
+            sql[0] += 1
+            sql[1] += seconds
+
+
+def summary(command=None):
+    wall = time.perf_counter() - _started
+    with _lock:
+        download_bytes = sum(size for _, size, _ in _downloads)
+        download_seconds = sum(seconds for _, _, seconds in _downloads)
+        return {
+            'command': command,
+            'argv': sys.argv[1:],
+            'started_at': _started_at.isoformat(),
+            'wall_s': round(wall, 6),
+            'phases': {
+                name: {'count': n, 'total_s': round(total, 6), 'max_s': round(longest, 6)}
+                for name, (n, total, longest) in sorted(_phases.items(), key=lambda item: -item[1][1])
+            },
+            'counters': dict(_counters),
+            'sql': {
+                'statements': sum(n for n, _ in _sql.values()),
+                'total_s': round(sum(total for _, total in _sql.values()), 6),
+                'by_kind': {kind: {'count': n, 'total_s': round(total, 6)} for kind, (n, total) in sorted(_sql.items())},
+            },
+            'downloads': {
+                'count': len(_downloads),
+                'bytes': download_bytes,
+                'seconds': round(download_seconds, 6),
+                'mb_per_s': round(download_bytes / download_seconds / 1e6, 3) if download_seconds else None,
+                'items': [
+                    {'path': path, 'bytes': size, 'seconds': round(seconds, 6),
+                     'mb_per_s': round(size / seconds / 1e6, 3) if seconds else None}
+                    for path, size, seconds in _downloads
+                ],
+            },
+        }
+
+
+def write(path, command=None):
+    with open(path, 'w') as f:
+        json.dump(summary(command), f, indent=2)
+
+
+def print_summary(command=None, file=sys.stderr):
+    report = summary(command)
+    print(f"\n{'='*20} profile: {command} ({report['wall_s']:.3f}s) {'='*20}", file=file)
+    for name, stats in report['phases'].items():
+        print(f"{name:<28}{stats['count']:>9} x {stats['total_s']:>10.3f}s  (max {stats['max_s']:.3f}s)", file=file)
+    sql = report['sql']
+    print(f"{'sql statements':<28}{sql['statements']:>9} x {sql['total_s']:>10.3f}s  "
+          + ", ".join(f"{kind} {stats['count']}" for kind, stats in sql['by_kind'].items()), file=file)
+    for name, value in report['counters'].items():
+        print(f"{name:<28}{value:>9}", file=file)
+    downloads = report['downloads']
+    if downloads['count']:
+        print(f"{'downloads':<28}{downloads['count']:>9} x {downloads['seconds']:>10.3f}s  "
+              f"{downloads['bytes'] / 1e6:.1f} MB, {downloads['mb_per_s']} MB/s", file=file)
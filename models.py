@@ -0,0 +1,197 @@
+from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, ForeignKey, Boolean, Enum, inspect, text, Index, event
+import enum
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.orm import sessionmaker, relationship
+
+from datetime import datetime
+
+from utils import post_shortcode, SQLITE_PROFILES, DB_PATH
+
+# Define enum classes
+class PostType(enum.Enum):
+    POST = 'post'
+    REEL = 'reel'
+    TV = 'tv'
+    OTHER = 'other'
+
+class ErrorClass(enum.Enum):
+    RATE_LIMITED = 'rate_limited'
+    NOT_FOUND = 'not_found'
+    NETWORK = 'network'
+    HTTP = 'http'
+    OTHER = 'other'
+
+# Create the base class for declarative models
+Base = declarative_base()
+
+# Define example models
+class Post(Base):
+    __tablename__ = 'posts'
+
+    id = Column(String(4), primary_key=True)
+    account = Column(String(50), unique=False)
+    url = Column(String(120), unique=False)
+    date_saved = Column(DateTime)
+    collection = Column(String(50))
+    post_type = Column(Enum(PostType))
+    created_at = Column(DateTime, default=datetime.utcnow)
+    is_downloaded = Column(Boolean, default=False)
+    last_download_failed = Column(Boolean, default=False)
+    # utils.post_shortcode(url), the same post saved under different urls has the same shortcode
+    shortcode = Column(String(120))
+
+    __table_args__ = (
+        # dedup: same post in the same collection / anywhere
+        Index('ix_posts_shortcode_collection', 'shortcode', 'collection'),
+        Index('ix_posts_url_collection', 'url', 'collection'),
+        # download queue: equality on the flags, then the (date_saved, id) keyset is a range seek in index order
+        Index('ix_posts_new_queue', 'is_downloaded', 'last_download_failed', 'date_saved', 'id'),
+        # play: downloaded reels of a collection in date order
+        Index('ix_posts_playback', 'post_type', 'is_downloaded', 'collection', 'date_saved'),
+    )
+    
+
+    def __repr__(self):
+        return f"<Post id:{self.id}, | account:{self.account}, | collection: {self.collection}, | url: {self.url}, | Downloaded: {self.is_downloaded}>"
+
+class IngestedFile(Base):
+    """Ledger of takeout files that were already added, so they are not parsed again"""
+    __tablename__ = 'ingested_files'
+
+    id = Column(Integer, primary_key=True)
+    path = Column(String(500))
+    size = Column(Integer)
+    mtime = Column(Float)
+    content_hash = Column(String(64), index=True)
+    inserted = Column(Integer)
+    skipped = Column(Integer)
+    ingested_at = Column(DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<IngestedFile path:{self.path}, | hash: {self.content_hash[:12]}, | inserted: {self.inserted}, | skipped: {self.skipped}>"
+
+
+
+class DownloadAttempt(Base):
+    """
+    Retry queue for posts whose download failed.
+    A post has a row here once its first download fails, the row is removed when it finally downloads.
+    """
+    __tablename__ = 'download_attempts'
+
+    post_id = Column(String(4), ForeignKey('posts.id'), primary_key=True)
+    attempts = Column(Integer, default=0)
+    last_error = Column(Enum(ErrorClass))
+    last_status = Column(Integer)
+    last_message = Column(String(500))
+    next_eligible_at = Column(DateTime)
+    retired = Column(Boolean, default=False)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+    # the scheduler only ever asks for "not retired and due"
+    __table_args__ = (Index('ix_download_attempts_due', 'retired', 'next_eligible_at'),)
+
+    def __repr__(self):
+        return f"<DownloadAttempt post:{self.post_id}, | attempts: {self.attempts}, | error: {self.last_error}, | next: {self.next_eligible_at}, | retired: {self.retired}>"
+
+
+class MediaAudit(Base):
+    """
+    Result of the last integrity check of a downloaded file (or photo folder).
+    Reused by the next audit as long as the size and mtime of the file did not change.
+    """
+    __tablename__ = 'media_audits'
+
+    path = Column(String(500), primary_key=True)
+    post_id = Column(String(4), index=True)
+    size = Column(Integer)
+    mtime = Column(Float)
+    problem = Column(String(500))
+    content_hash = Column(String(64))
+    audited_at = Column(DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<MediaAudit path:{self.path}, | problem: {self.problem}, | audited: {self.audited_at}>"
+
+
+def migrate_db(engine):
+    """Bring an existing reels.sqlite up to date with the models, safe to run every time"""
+    inspector = inspect(engine)
+    had_attempts_table = inspector.has_table(DownloadAttempt.__tablename__)
+
+    # create any table added after the db was first set up (posts is left untouched)
+    Base.metadata.create_all(engine)
+
+    # columns and indexes added to posts after it was created
+    post_columns = [column['name'] for column in inspector.get_columns(Post.__tablename__)]
+    with engine.begin() as conn:
+        if 'shortcode' not in post_columns:
+            print("Adding shortcode column to posts")
+            conn.execute(text("ALTER TABLE posts ADD COLUMN shortcode VARCHAR(120)"))
+        # replaced by ix_posts_new_queue, post_type in the middle kept it from serving the queue order
+        conn.execute(text("DROP INDEX IF EXISTS ix_posts_download_queue"))
+        for index in Post.__table__.indexes:
+            index.create(conn, checkfirst=True)
+        # rows written before the column existed (cheap index seek when there are none)
+        missing = conn.execute(text("SELECT id, url FROM posts WHERE shortcode IS NULL")).all()
+        if missing:
+            conn.execute(
+                text("UPDATE posts SET shortcode = :shortcode WHERE id = :id"),
+                [{'id': post_id, 'shortcode': post_shortcode(url or '')} for post_id, url in missing])
+
+    if not had_attempts_table:
+        # posts that failed before the retry queue existed get one more chance
+        with engine.begin() as conn:
+            conn.execute(text("""
+                INSERT INTO download_attempts (post_id, attempts, last_error, next_eligible_at, retired, updated_at)
+                SELECT id, 1, 'OTHER', :now, 0, :now FROM posts
+                WHERE last_download_failed = 1 AND is_downloaded = 0
+            """), {'now': datetime.utcnow()})
+
+# one engine (and connection pool) per db file and profile for the whole process
+_engines = {}
+
+def get_engine(db_path=DB_PATH, profile='performance', echo=False):
+    """Shared engine for db_path with the PRAGMAs of the given SQLITE_PROFILES profile"""
+    key = (db_path, profile)
+    if key in _engines:
+        return _engines[key]
+
+    pragmas = SQLITE_PROFILES[profile]
+    engine = create_engine(f'sqlite:///{db_path}', echo=echo,
+                           connect_args={'timeout': pragmas['busy_timeout'] / 1000})
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    _engines[key] = engine
+    return engine
+
+def init_db(db_path=DB_PATH, profile='performance'):
+    """Initialize the database, create tables"""
+    engine = get_engine(db_path, profile)
+    
+    # Create all tables
+    Base.metadata.create_all(engine)
+    
+    # Create session factory
+    Session = sessionmaker(bind=engine)
+    
+    return Session()
+
+def get_session(db_path=DB_PATH, profile='performance'):
+    """Creates a session attached to an existing sqlite file based db"""
+    engine = get_engine(db_path, profile)
+
+    migrate_db(engine)
+
+    # Create session factory
+    Session = sessionmaker(bind=engine)
+
+    print(f"Connected to existing database, \"{db_path}\" ({profile} profile)")
+
+    return engine, Session()
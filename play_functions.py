@@ -1,35 +1,22 @@
-import os
-from subprocess import call
+from commands import get_session, play_videos
+from utils import DB_PATH
 
 
-def play_untagged_non_collection_videos(favs_folder_location, reels_non_collection_location):
+def play_untagged_non_collection_videos(favs_folder_location, db_path=DB_PATH, playlist_path=None):
     """
-    Plays all files in the reels_non_collection folder 
-    that have not been categorized in the Favs folder yet
+    Plays all downloaded reels without a collection
+    that have not been categorized in the Favs folder yet.
+    The reels come from the db, only the Favs folder is scanned.
     """
-    tagged_file_list = []
-    for root, dirs, files in os.walk(favs_folder_location):
-        for file in files:
-            tagged_file_list.append(file)
+    engine, session = get_session(db_path)
+    try:
+        play_videos(session, collection="None", untagged=True, playlist_path=playlist_path, favs_root=favs_folder_location)
+    finally:
+        session.close()
+        engine.dispose()
 
-    file_list = []
-    for root, dirs, files in os.walk(reels_non_collection_location):
-        for file in files:
-            file_list.append(file)
-
-    untagged_file_list = set(file_list) - set(tagged_file_list)
-
-    untagged_file_list_location = [reels_non_collection_location + "/" + i for i in untagged_file_list]
-
-    call(["vlc"] + untagged_file_list_location)
-
-
-
-    
 
 if __name__ == '__main__':
     favs_folder_location = "/home/namit/Downloads/ig_saved/Favs"
-    reels_non_collection_location = "/home/namit/Downloads/ig_saved/reels_non_collection"
 
-    a = play_untagged_non_collection_videos(favs_folder_location, reels_non_collection_location)
-    print(a)
\ No newline at end of file
+    play_untagged_non_collection_videos(favs_folder_location)
@@ -1,11 +1,40 @@
 import os
-import instaloader
-from instaloader import Post
-import requests
 import re
 from datetime import datetime
 import json
-import shortuuid
+import hashlib
+import threading
+import time
+import shutil
+from collections import deque
+from itertools import islice
+try:
+    import fcntl
+except ImportError:
+    # windows, no reflinks
+    fcntl = None
+
+import metrics
+
+# PRAGMAs applied to every new sqlite connection, per profile
+SQLITE_PROFILES = {
+    # sqlite defaults, only wait for locks instead of failing right away
+    'default': {
+        'busy_timeout': 30000,
+    },
+    # WAL lets readers (play, find-link) run while a download or import is writing
+    'performance': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -64000,       # 64 MiB page cache
+        'mmap_size': 268435456,     # 256 MiB
+        'temp_store': 'MEMORY',
+        'busy_timeout': 30000,
+    },
+}
+DB_PATH = 'reels.sqlite'
+# sqlite refuses statements with more bound parameters than this (999 on older builds)
+SQLITE_MAX_VARIABLES = 999
 
 def get_post_type(url):
     url = url.lower()
@@ -31,85 +60,816 @@ def file_exists(id):
     else:
         return False
 
+# folder -> (holds collection posts, holds photo folders instead of .mp4 files)
+MEDIA_FOLDERS = {
+    "reels": (True, False),
+    "reels_non_collection": (False, False),
+    "photos": (True, True),
+    "photos_non_collection": (False, True),
+}
+
+def media_folder(is_collection, is_reel):
+    for folder, (folder_is_collection, folder_is_photos) in MEDIA_FOLDERS.items():
+        if folder_is_collection == is_collection and folder_is_photos != is_reel:
+            return folder
+
+def scan_media_folders(root="."):
+    """
+    Index every downloaded post with a single os.scandir pass per media folder.
+    Returns {id: (folder, size, mtime)}. Unfinished .part downloads are ignored.
+    """
+    index = {}
+    for folder, (_, is_photos) in MEDIA_FOLDERS.items():
+        path = os.path.join(root, folder)
+        if not os.path.isdir(path):
+            continue
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if is_photos:
+                    if not entry.is_dir() or entry.name.endswith((".part", ".corrupt")):
+                        continue
+                    post_id = entry.name
+                else:
+                    if not entry.name.endswith(".mp4") or not entry.is_file():
+                        continue
+                    post_id = entry.name[:-len(".mp4")]
+                if post_id in index:
+                    print(f"{post_id} found in both {index[post_id][0]} and {folder}, using {index[post_id][0]}")
+                    continue
+                stat = entry.stat()
+                index[post_id] = (folder, stat.st_size, stat.st_mtime)
+    return index
+
+# reels that were sorted into Favs/<tag>/ by hand
+FAVS_FOLDER = "Favs"
+
+def scan_tagged_ids(favs_root):
+    """
+    Ids of every .mp4 anywhere under the Favs folder.
+    Names only: os.scandir already knows which entries are folders, no file is stat'ed.
+    """
+    tagged = set()
+    folders = [favs_root]
+    while folders:
+        try:
+            entries = os.scandir(folders.pop())
+        except FileNotFoundError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append(entry.path)
+                elif entry.name.endswith(".mp4"):
+                    tagged.add(entry.name[:-len(".mp4")])
+    return tagged
+
+def write_m3u(file, entries):
+    file.write("#EXTM3U\n")
+    count = 0
+    for path, title in entries:
+        file.write(f"#EXTINF:-1,{title}\n{path}\n")
+        count += 1
+    return count
+
+def write_xspf(file, entries):
+    from xml.sax.saxutils import escape
+    import pathlib
+    file.write('<?xml version="1.0" encoding="UTF-8"?>\n<playlist version="1" xmlns="http://xspf.org/ns/0/">\n<trackList>\n')
+    count = 0
+    for path, title in entries:
+        location = escape(pathlib.Path(path).absolute().as_uri())
+        file.write(f"<track><location>{location}</location><title>{escape(title)}</title></track>\n")
+        count += 1
+    file.write("</trackList>\n</playlist>\n")
+    return count
+
+PLAYLIST_WRITERS = {
+    '.m3u': write_m3u,
+    '.m3u8': write_m3u,
+    '.xspf': write_xspf,
+}
+
+def write_playlist(path, entries):
+    """
+    Stream (path, title) entries into an m3u or xspf playlist (picked by extension),
+    one line at a time so the list of videos is never held in memory.
+    Returns the number of entries written.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in PLAYLIST_WRITERS:
+        raise ValueError(f"Unknown playlist format {extension!r}, use one of {', '.join(PLAYLIST_WRITERS)}")
+    with open(path, 'w', encoding='utf-8') as file:
+        return PLAYLIST_WRITERS[extension](file, entries)
+
 # function that downloads a reel
+# Pattern to match the ID after /p/ (or /reel/, /reels/, /tv/)
+SHORTCODE_PATTERN = re.compile(r'/(p|reel|reels|tv)/([^/?#]+)')
+
 def extract_instagram_id(url):
-    # Pattern to match the ID after /p/
-    pattern = r'/(p|reel)/([^/]+)'
-    match = re.search(pattern, url)
+    match = SHORTCODE_PATTERN.search(url)
     if match:
         return match.group(2)
     else:
         print("Video ID not found in url: ", url)
     return None
 
-def download(url, filename, is_collection, is_reel):
+def post_shortcode(url):
+    """
+    Normalized key of a post, used to find the same post saved under slightly different urls
+    (query strings, /reel/ vs /p/). Falls back to the url without its query string.
+    """
+    match = SHORTCODE_PATTERN.search(url)
+    if match:
+        return match.group(2)
+    return url.split('?')[0].rstrip('/')
+
+# status codes instagram answers with when we are going too fast
+THROTTLE_STATUS_CODES = (401, 429)
+
+class DownloadHTTPError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"Non 200 response code: {status_code}")
+        self.status_code = status_code
+
+def is_throttle_error(e):
+    """True if the exception means instagram wants us to slow down"""
+    from instaloader.exceptions import TooManyRequestsException, AbortDownloadException, ConnectionException
+    if isinstance(e, DownloadHTTPError):
+        return e.status_code in THROTTLE_STATUS_CODES
+    if isinstance(e, (TooManyRequestsException, AbortDownloadException)):
+        return True
+    if isinstance(e, ConnectionException):
+        # instaloader wraps 429/401 responses into a ConnectionException once it gives up
+        message = str(e)
+        return any(marker in message for marker in ("429", "401", "Please wait a few minutes"))
+    return False
+
+def classify_download_error(e):
+    """
+    Sort a download failure into one of the buckets used by the retry queue.
+    Returns (error class, http status code or None).
+    error class is one of 'rate_limited', 'not_found', 'network', 'http', 'other'
+    """
+    import requests
+    from instaloader.exceptions import ConnectionException, LoginRequiredException, QueryReturnedNotFoundException, \
+        QueryReturnedForbiddenException, QueryReturnedBadRequestException, BadResponseException
+    if isinstance(e, DownloadHTTPError):
+        if e.status_code in THROTTLE_STATUS_CODES:
+            return 'rate_limited', e.status_code
+        if e.status_code in (404, 410):
+            return 'not_found', e.status_code
+        return 'http', e.status_code
+    if is_throttle_error(e) or isinstance(e, LoginRequiredException):
+        return 'rate_limited', None
+    # deleted / private posts: instaloader either gets a 404 or no metadata at all
+    if isinstance(e, QueryReturnedNotFoundException):
+        return 'not_found', 404
+    if isinstance(e, BadResponseException):
+        return 'not_found', None
+    if isinstance(e, QueryReturnedForbiddenException):
+        return 'http', 403
+    if isinstance(e, QueryReturnedBadRequestException):
+        return 'http', 400
+    if isinstance(e, (ConnectionException, requests.exceptions.RequestException, OSError)):
+        return 'network', None
+    return 'other', None
+
+class RateLimiter:
+    """
+    Token bucket shared by every download thread, sitting in front of all instagram requests.
+    The rate is halved and requests are paused (exponential backoff) whenever instagram throttles us,
+    and it creeps back up by a small step after every successful request.
+    """
+    def __init__(self, rate=0.5, min_rate=0.02, max_rate=2.0, burst=1,
+                 increase=0.01, decrease=0.5, backoff=30, max_backoff=900):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.consecutive_throttles = 0
+        # counters
+        self.requests = 0
+        self.successes = 0
+        self.throttles = 0
+        self.retries = 0
+        self.waited = 0.0
+
+    def acquire(self):
+        """Block until the next request is allowed"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    delay = self.paused_until - now
+                else:
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        self.requests += 1
+                        return
+                    delay = (1 - self.tokens) / self.rate
+                self.waited += delay
+            time.sleep(delay)
+
+    def success(self):
+        with self.lock:
+            self.successes += 1
+            self.consecutive_throttles = 0
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def throttled(self, retry_after=None):
+        with self.lock:
+            self.throttles += 1
+            self.consecutive_throttles += 1
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self.tokens = 0
+            if retry_after is None:
+                retry_after = min(self.max_backoff, self.backoff * 2 ** (self.consecutive_throttles - 1))
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+            print(f"Throttled by instagram. Rate is now {self.rate:.3f} req/s, pausing for {retry_after:.0f}s")
+
+    def retried(self):
+        with self.lock:
+            self.retries += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'rate': round(self.rate, 4),
+                'requests': self.requests,
+                'successes': self.successes,
+                'throttles': self.throttles,
+                'retries': self.retries,
+                'waited_seconds': round(self.waited, 1),
+            }
+
+    def __repr__(self):
+        stats = self.stats()
+        return f"<RateLimiter rate: {stats['rate']} req/s, | requests: {stats['requests']}, | throttles: {stats['throttles']}, | retries: {stats['retries']}>"
+
+def retry_after_seconds(response):
+    value = response.headers.get('Retry-After')
+    if value and value.isdigit():
+        return int(value)
+    return None
+
+# bytes read from the socket / written to disk at a time while downloading media
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# images of a single carousel post downloaded at the same time
+SIDECAR_WORKERS = 4
+# (connect, read) seconds for media requests, a stalled CDN connection fails as a network error
+MEDIA_TIMEOUT = (10, 60)
+# media requests per second, they go to the CDN and not to the instagram API so get their own limiter
+MEDIA_RATE = 5.0
+
+class Downloader:
+    """
+    One Instaloader context and one pooled requests session shared by a whole download run,
+    so every post does not pay for a new context and a new TCP/TLS handshake.
+    Post lookups go through limiter, media requests through media_limiter, both are retried
+    when we get throttled. Only post lookups ramp up the instagram API rate.
+    Safe to share between download threads.
+    """
+    def __init__(self, pool_size=10, limiter=None, max_retries=3, chunk_size=DOWNLOAD_CHUNK_SIZE, store=None, timeout=MEDIA_TIMEOUT, media_limiter=None):
+        # instaloader and requests are only imported by commands that download
+        import instaloader
+        import requests
+        from requests.adapters import HTTPAdapter
+        from concurrent.futures import ThreadPoolExecutor
+
+        # retries on 429 are done by our rate limiter, not by instaloader
+        self.loader = instaloader.Instaloader(max_connection_attempts=1)
+        self.session = requests.Session()
+        # one keep-alive connection per download thread (and per carousel image being fetched)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size * SIDECAR_WORKERS)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.limiter = limiter if limiter is not None else RateLimiter()
+        # every carousel image of every thread may start at once
+        self.media_limiter = media_limiter if media_limiter is not None else \
+            RateLimiter(rate=MEDIA_RATE, max_rate=MEDIA_RATE, burst=pool_size * SIDECAR_WORKERS)
+        self.max_retries = max_retries
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        # optional MediaStore, reels whose shortcode is already stored are linked instead of downloaded
+        self.store = store
+        # carousel images of a post are fetched in parallel on this pool
+        self.media_executor = ThreadPoolExecutor(max_workers=pool_size * SIDECAR_WORKERS)
+
+    @metrics.timed('instagram metadata')
+    def get_post(self, shortcode):
+        import instaloader
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire()
+            try:
+                post = instaloader.Post.from_shortcode(self.loader.context, shortcode)
+            except Exception as e:
+                if not is_throttle_error(e):
+                    raise
+                self.limiter.throttled()
+                if attempt == self.max_retries:
+                    raise
+                self.limiter.retried()
+                continue
+            self.limiter.success()
+            return post
+
+    def get(self, url, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            self.media_limiter.acquire()
+            # without a timeout one stalled connection would hold its download thread forever
+            response = self.session.get(url, timeout=self.timeout, **kwargs)
+            if response.status_code not in THROTTLE_STATUS_CODES:
+                self.media_limiter.success()
+                return response
+            self.media_limiter.throttled(retry_after_seconds(response))
+            if attempt == self.max_retries:
+                return response
+            response.close()
+            self.media_limiter.retried()
+
+    def close(self):
+        self.media_executor.shutdown()
+        self.session.close()
+        self.loader.close()
+
+def download(url, filename, is_collection, is_reel, downloader=None):
+    # without a shared downloader every call sets up its own (slow for long runs)
+    if downloader is None:
+        downloader = Downloader(pool_size=1)
+        try:
+            return download(url, filename, is_collection, is_reel, downloader)
+        finally:
+            # its session, instaloader context and media threads would outlive the call otherwise
+            downloader.close()
     if is_reel:
-        download_reel(url, filename, is_collection)
+        download_reel(url, filename, is_collection, downloader)
     else:
-        download_photo(url, filename, is_collection)
+        download_photo(url, filename, is_collection, downloader)
+
+def get_media_urls(post):
+    """(url, file extension) of every image / video in a post, carousels (sidecars) included"""
+    if post.typename == 'GraphSidecar':
+        return [(node.video_url, '.mp4') if node.is_video else (node.display_url, '.jpeg')
+                for node in post.get_sidecar_nodes()]
+    if post.is_video:
+        return [(post.video_url, '.mp4')]
+    return [(post.url, '.jpeg')]
 
-def download_photo(photo_url, filename, is_collection):
+def download_photo(photo_url, filename, is_collection, downloader):
+    """
+    Download every image of a photo / carousel post into photos/<id>/<index>.jpeg
+    All images are fetched at the same time over the shared session, into a <id>.part folder
+    that is renamed into place once every image is there.
+    """
     try:
         download_folder = "photos" if is_collection else "photos_non_collection"
-        L = instaloader.Instaloader()
         photo_id = extract_instagram_id(photo_url)
-        post = Post.from_shortcode(L.context, photo_id)
-        urls = [img.display_url for img in post.get_sidecar_nodes()]
-        print(urls)
+        post = downloader.get_post(photo_id)
+        media = get_media_urls(post)
 
-        # create folder for the post
         download_location = download_folder + "/" + filename
-        os.mkdir(download_location)
-        print(download_location)
-        
-        for idx,url in enumerate(urls):
-            print("creating response object")
-            response = requests.get(url)
-
-            import pickle
-            with open('data.pkl', 'wb') as f:
-                pickle.dump(post, f)
-                print("post saved")
-
-            with open(download_location + "/" + str(idx) + '.jpeg', 'wb') as handler:
-                handler.write(response.content)
-            print("--- Download Success ---")
-            print("Response: ", response)
-        else:
-            print("X"*50 + "Download Failed (photos)" + "X"*50)
-            print("Status Code: ", response.status_code)
-            print("Response: ", response)
-            raise Exception("Non 200 response code")
+        part_location = download_location + ".part"
+        os.makedirs(part_location, exist_ok=True)
+
+        futures = [
+            downloader.media_executor.submit(download_to_file, downloader, url, part_location + "/" + str(idx) + extension)
+            for idx, (url, extension) in enumerate(media)
+        ]
+        # wait for every image, the first failure (if any) is raised here
+        sizes = [future.result() for future in futures]
+
+        # a folder left over from an older (failed) run is replaced
+        if os.path.isdir(download_location):
+            shutil.rmtree(download_location)
+        os.replace(part_location, download_location)
+        metrics.log(f"--- Download Success ({len(sizes)} files, {sum(sizes)} bytes) ---")
     except Exception as e:
         print("X"*50 + "Download Failed (photos)" + "X"*50)
         print("Exception: ", e)
         raise
 
-def download_reel(video_url, filename, is_collection):
+class IncompleteDownloadError(IOError):
+    pass
+
+def parse_content_range(value):
+    """'bytes 100-199/1000' -> (100, 1000), 'bytes */1000' -> (None, 1000), '*' parts come back as None"""
+    match = re.match(r'bytes (?:(\d+)-\d+|\*)/(\d+|\*)', value or '')
+    if not match:
+        return None, None
+    start = int(match.group(1)) if match.group(1) is not None else None
+    total = int(match.group(2)) if match.group(2) != '*' else None
+    return start, total
+
+def download_to_file(downloader, url, path):
+    """
+    Stream url into path + '.part' and rename it to path once it is complete.
+    A .part file left behind by an interrupted run is resumed with a Range request
+    when the server supports it, so bytes that are already on disk are not fetched again.
+    A file is only moved into place after its size matches what the server announced.
+    Returns the size of the file.
+    """
+    part_path = path + '.part'
+    start_time = time.perf_counter()
+    for attempt in range(2):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        # the with block hands the connection back to the pool for the next download
+        with downloader.get(url, stream=True, headers=headers) as response:
+            if response.status_code == 416 and offset:
+                # nothing left to send, either the part file is already complete or it is garbage
+                _, total = parse_content_range(response.headers.get('Content-Range'))
+                if total == offset:
+                    break
+                os.remove(part_path)
+                continue
+            if response.status_code == 206:
+                start, total = parse_content_range(response.headers.get('Content-Range'))
+                if start != offset:
+                    # server answered with a different range than we asked for, start over
+                    os.remove(part_path)
+                    continue
+                mode = 'ab'
+                print(f"Resuming {path} from {offset} bytes")
+            elif response.status_code == 200:
+                # no range support (or a fresh download), rewrite the whole file
+                total = int(response.headers['Content-Length']) if 'Content-Length' in response.headers else None
+                mode = 'wb'
+            else:
+                print("Status Code: ", response.status_code)
+                print("Response: ", response)
+                raise DownloadHTTPError(response.status_code)
+            # content-length is the compressed size if the server gzips the response
+            if response.headers.get('Content-Encoding', 'identity') != 'identity':
+                total = None
+
+            with open(part_path, mode) as file:
+                for chunk in response.iter_content(chunk_size=downloader.chunk_size):
+                    if chunk:
+                        file.write(chunk)
+                file.flush()
+                os.fsync(file.fileno())
+        break
+    else:
+        raise IncompleteDownloadError(f"Could not resume {part_path}")
+
+    size = os.path.getsize(part_path)
+    if total is not None and size != total:
+        # keep the part file, the next attempt resumes from here
+        raise IncompleteDownloadError(f"Got {size} of {total} bytes for {path}")
+    os.replace(part_path, path)
+    seconds = time.perf_counter() - start_time
+    metrics.add_time('transfer', seconds)
+    metrics.record_download(path, size, seconds)
+    return size
+
+def download_reel(video_url, filename, is_collection, downloader):
     try:
         download_folder = "reels" if is_collection else "reels_non_collection"
-        L = instaloader.Instaloader()
         video_id = extract_instagram_id(video_url)
-        post = Post.from_shortcode(L.context, video_id)
+        path = download_folder + "/" + filename + '.mp4'
+        store = downloader.store if video_id else None
+        if store is not None:
+            blob_path = store.find(video_id)
+            if blob_path is not None:
+                # already downloaded for another post with the same shortcode, no network needed
+                store.link(blob_path, path)
+                metrics.count('linked from media store')
+                metrics.log(f"--- Linked from media store ({blob_path}) ---")
+                return
+        post = downloader.get_post(video_id)
         url = post.video_url
-        response = requests.get(url, stream=True)
-        if response.status_code == 200:
-            with open(download_folder + "/" + filename + '.mp4', 'wb') as file:
-                for chunk in response.iter_content(chunk_size=1024):
-                    if chunk:
-                        file.write(chunk)
-            print("--- Download Success ---")
-            print("Response: ", response)
-        else:
-            print("X"*50 + "Download Failed (videos)" + "X"*50)
-            print("Status Code: ", response.status_code)
-            print("Response: ", response)
-            raise Exception("Non 200 response code")
+        size = download_to_file(downloader, url, path)
+        if store is not None:
+            store.add(video_id, path)
+        metrics.log(f"--- Download Success ({size} bytes) ---")
     except Exception as e:
         print("X"*50 + "Download Failed (videos)" + "X"*50)
         print("Exception: ", e)
         raise
 
+# ioctl that clones a file's extents (copy on write) on btrfs / xfs
+FICLONE = 0x40049409
+
+def reflink(source_path, destination_path):
+    with open(source_path, 'rb') as source, open(destination_path, 'wb') as destination:
+        try:
+            fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+        except Exception:
+            destination.close()
+            os.remove(destination_path)
+            raise
+
+def link_or_copy(source_path, destination_path, symlink=False):
+    """
+    Make destination_path have the same content as source_path without copying bytes when possible:
+    a hardlink, else a reflink (where the filesystem supports it), else (if allowed) a symlink,
+    else a regular copy.
+    Returns the method that worked.
+    """
+    try:
+        os.link(source_path, destination_path)
+        return "hardlink"
+    except OSError:
+        pass
+    if fcntl is not None:
+        try:
+            reflink(source_path, destination_path)
+            return "reflink"
+        except OSError:
+            pass
+    if symlink:
+        try:
+            os.symlink(os.path.abspath(source_path), destination_path)
+            return "symlink"
+        except OSError:
+            pass
+    shutil.copy2(source_path, destination_path)
+    return "copy"
+
+def link_media(source_path, destination_path):
+    """link_or_copy() for a downloaded post: a reel file or a photo folder (each of its files)"""
+    if not os.path.isdir(source_path):
+        return link_or_copy(source_path, destination_path)
+    os.makedirs(destination_path, exist_ok=True)
+    methods = {link_or_copy(os.path.join(source_path, name), os.path.join(destination_path, name))
+               for name in os.listdir(source_path)}
+    return "+".join(sorted(methods)) or "empty"
+
+class MediaStore:
+    """
+    Optional content addressed storage for reels.
+    Every video is stored once as <root>/<shortcode>/<sha256>.mp4 and the per post
+    reels/<id>.mp4 files are links to it, so a reel saved in several collections
+    takes the disk space (and the download) of one.
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def find(self, shortcode):
+        """Path of a stored blob for this shortcode, None if it was never downloaded"""
+        folder = os.path.join(self.root, shortcode)
+        if not os.path.isdir(folder):
+            return None
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.name.endswith(".mp4") and entry.is_file():
+                    return entry.path
+        return None
+
+    def quarantine(self, shortcode, path):
+        """
+        Rename the stored blob(s) that path is a link of to <blob>.corrupt, so find() no longer
+        hands them out. Returns the renamed blob paths.
+        """
+        folder = os.path.join(self.root, shortcode)
+        if not os.path.isdir(folder):
+            return []
+        quarantined = []
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.name.endswith(".mp4") and entry.is_file() and os.path.samefile(entry.path, path):
+                    os.replace(entry.path, entry.path + ".corrupt")
+                    quarantined.append(entry.path)
+        return quarantined
+
+    def link(self, blob_path, path):
+        # link next to the destination first so the swap is atomic
+        temp_path = path + ".link"
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+        link_or_copy(blob_path, temp_path, symlink=True)
+        os.replace(temp_path, path)
+
+    def add(self, shortcode, path):
+        """Move a downloaded file into the store and leave a link in its place. Returns the blob path"""
+        digest = file_sha256(path)
+        folder = os.path.join(self.root, shortcode)
+        os.makedirs(folder, exist_ok=True)
+        blob_path = os.path.join(folder, digest + os.path.splitext(path)[1])
+        if os.path.exists(blob_path):
+            # same bytes are already stored (e.g. the same reel in another collection)
+            if not os.path.samefile(blob_path, path):
+                os.remove(path)
+        else:
+            shutil.move(path, blob_path)
+        if not os.path.exists(path):
+            self.link(blob_path, path)
+        return blob_path
+
+def file_sha256(filepath, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def check_mp4(path):
+    """
+    Walk the top level boxes of an mp4 without reading the media data.
+    Returns None if the file looks complete, otherwise what is wrong with it:
+    no ftyp box first, a box too small to hold its header or running past the end
+    of the file (a stream that was cut off) or no moov box (nothing to play).
+    Box types are not checked, encoders add their own (vendor uuid, Xtra, ...).
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return "empty"
+    seen = set()
+    with open(path, 'rb') as f:
+        offset = 0
+        while offset < size:
+            f.seek(offset)
+            header = f.read(8)
+            if len(header) < 8:
+                return f"truncated box header at {offset}"
+            box_size = int.from_bytes(header[:4], 'big')
+            box_type = header[4:]
+            if box_size == 1:
+                # 64 bit size follows the type
+                large = f.read(8)
+                if len(large) < 8:
+                    return f"truncated box header at {offset}"
+                box_size = int.from_bytes(large, 'big')
+            elif box_size == 0:
+                # box runs to the end of the file
+                box_size = size - offset
+            if not seen and box_type != b'ftyp':
+                return f"starts with {box_type!r} instead of ftyp"
+            if box_size < 8:
+                return f"invalid size {box_size} for {box_type!r} at {offset}"
+            if offset + box_size > size:
+                return f"truncated: {box_type!r} box needs {offset + box_size} bytes, file has {size}"
+            seen.add(box_type)
+            offset += box_size
+    if b'moov' not in seen:
+        return "no moov box"
+    return None
+
+def check_jpeg(path):
+    """None if the file starts and ends with the jpeg markers, otherwise what is wrong"""
+    size = os.path.getsize(path)
+    if size == 0:
+        return "empty"
+    with open(path, 'rb') as f:
+        if f.read(2) != b'\xff\xd8':
+            return "not a jpeg"
+        f.seek(-2, os.SEEK_END)
+        if f.read(2) != b'\xff\xd9':
+            return "truncated jpeg"
+    return None
+
+def audit_media(path, with_hash=False):
+    """
+    Check one downloaded post: a reel .mp4 file or a photo folder.
+    Runs in the audit process pool, returns (path, problem or None, sha256 or None).
+    """
+    try:
+        if os.path.isdir(path):
+            names = sorted(os.listdir(path))
+            if not names:
+                return path, "empty folder", None
+            digest = hashlib.sha256() if with_hash else None
+            for name in names:
+                file_path = os.path.join(path, name)
+                if name.endswith('.mp4'):
+                    problem = check_mp4(file_path)
+                elif name.endswith(('.jpeg', '.jpg')):
+                    problem = check_jpeg(file_path)
+                else:
+                    continue
+                if problem:
+                    return path, f"{name}: {problem}", None
+                if digest:
+                    digest.update(bytes.fromhex(file_sha256(file_path)))
+            return path, None, digest.hexdigest() if digest else None
+        problem = check_mp4(path)
+        if problem:
+            return path, problem, None
+        return path, None, file_sha256(path) if with_hash else None
+    except OSError as e:
+        return path, f"unreadable: {e}", None
+
+def media_signature(path):
+    """(size, mtime) of a file, or of every file in a photo folder combined. None if it does not exist"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    if not os.path.isdir(path):
+        return stat.st_size, stat.st_mtime
+    size, mtime = 0, stat.st_mtime
+    with os.scandir(path) as entries:
+        for entry in entries:
+            entry_stat = entry.stat()
+            size += entry_stat.st_size
+            mtime = max(mtime, entry_stat.st_mtime)
+    return size, mtime
+
+# every post id is 4 characters of shortuuid's default alphabet
+ID_ALPHABET = "23456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+ID_LENGTH = 4
+
+class IdAllocator:
+    """
+    Hands out post ids that are not used yet.
+    Every possible id (57^4, about 10.5 million) is one bit of a bytearray (1.3 MB),
+    so checking and taking an id is O(1) and never touches the db.
+    Ids that do not fit the alphabet / length are kept in a plain set.
+    """
+    def __init__(self, used_ids=(), alphabet=ID_ALPHABET, length=ID_LENGTH):
+        import random
+        self.alphabet = alphabet
+        self.length = length
+        self.positions = {char: i for i, char in enumerate(alphabet)}
+        self.keyspace = len(alphabet) ** length
+        self.bitmap = bytearray((self.keyspace + 7) // 8)
+        self.overflow = set()
+        self.used = 0
+        self.random = random.Random()
+        for post_id in used_ids:
+            self.add(post_id)
+
+    def key(self, post_id):
+        """Position of post_id in the bitmap, None if it cannot be one of ours"""
+        if post_id is None or len(post_id) != self.length:
+            return None
+        key = 0
+        for char in post_id:
+            position = self.positions.get(char)
+            if position is None:
+                return None
+            key = key * len(self.alphabet) + position
+        return key
+
+    def id(self, key):
+        chars = []
+        for _ in range(self.length):
+            key, position = divmod(key, len(self.alphabet))
+            chars.append(self.alphabet[position])
+        return "".join(reversed(chars))
+
+    def __contains__(self, post_id):
+        key = self.key(post_id)
+        if key is None:
+            return post_id in self.overflow
+        return bool(self.bitmap[key >> 3] & (1 << (key & 7)))
+
+    def add(self, post_id):
+        """Mark post_id as used, returns False if it already was"""
+        key = self.key(post_id)
+        if key is None:
+            if post_id in self.overflow:
+                return False
+            self.overflow.add(post_id)
+            return True
+        if self.bitmap[key >> 3] & (1 << (key & 7)):
+            return False
+        self.bitmap[key >> 3] |= 1 << (key & 7)
+        self.used += 1
+        return True
+
+    def allocate(self, preferred=None):
+        """A new unused id (preferred if it is still free), marked as used right away"""
+        if preferred is not None and self.add(preferred):
+            return preferred
+        if self.used >= self.keyspace:
+            raise RuntimeError(f"All {self.keyspace} post ids are in use")
+        # random probes are O(1) on average until the keyspace is nearly full
+        for _ in range(64):
+            key = self.random.randrange(self.keyspace)
+            if not self.bitmap[key >> 3] & (1 << (key & 7)):
+                post_id = self.id(key)
+                self.add(post_id)
+                return post_id
+        # nearly full, take the first free id after a random byte
+        from itertools import chain
+        start = self.random.randrange(len(self.bitmap))
+        for index in chain(range(start, len(self.bitmap)), range(start)):
+            if self.bitmap[index] != 0xFF:
+                for bit in range(8):
+                    key = index * 8 + bit
+                    if key < self.keyspace and not self.bitmap[index] & (1 << bit):
+                        post_id = self.id(key)
+                        self.add(post_id)
+                        return post_id
+        raise RuntimeError(f"All {self.keyspace} post ids are in use")
+
+    def occupancy(self):
+        return self.used / self.keyspace
+
+    def __repr__(self):
+        return f"<IdAllocator {self.used:,} of {self.keyspace:,} ids used ({self.occupancy():.2%}), {len(self.overflow)} outside the keyspace>"
+
 def detect_file_type(filepath):
     filename = os.path.basename(filepath)
     if filename == "saved_collections.json":
@@ -119,6 +879,26 @@ def detect_file_type(filepath):
     else:
         raise Exception("INCOMPATIBLE FILE FOUND")
 
+def parse_collection_entry(p, collection_title):
+    return {
+        'account':p['string_map_data']['Name']['value'] if 'value' in p['string_map_data']['Name'] else None,
+        'url':p['string_map_data']['Name']['href'],
+        'shortcode':post_shortcode(p['string_map_data']['Name']['href']),
+        'date_saved':datetime.fromtimestamp(p['string_map_data']['Added Time']['timestamp']),
+        'collection':collection_title,
+        'post_type':get_post_type(p['string_map_data']['Name']['href'])
+    }
+
+def parse_non_collection_entry(p):
+    return {
+        'account':p['title'] if 'title' in p else None,
+        'url':p['string_map_data']['Saved on']['href'],
+        'shortcode':post_shortcode(p['string_map_data']['Saved on']['href']),
+        'date_saved':datetime.fromtimestamp(p['string_map_data']['Saved on']['timestamp']),
+        'collection':None,
+        'post_type':get_post_type(p['string_map_data']['Saved on']['href'])
+    }
+
 def parse_saved_posts(saved_posts_raw):
     saved_posts = {}
     for p in saved_posts_raw['saved_saved_collections']:
@@ -131,31 +911,183 @@ def parse_saved_posts(saved_posts_raw):
                 saved_posts[current_collection_title] = []
 
         else:
-            reel = {
-                'id':shortuuid.ShortUUID().random(length=4),
-                'account':p['string_map_data']['Name']['value'] if 'value' in p['string_map_data']['Name'] else None,
-                'url':p['string_map_data']['Name']['href'],
-                'date_saved':datetime.fromtimestamp(p['string_map_data']['Added Time']['timestamp']),
-                'collection':current_collection_title,
-                'post_type':get_post_type(p['string_map_data']['Name']['href'])
-            }
+            reel = parse_collection_entry(p, current_collection_title)
             saved_posts[current_collection_title].append(reel)
     return saved_posts
 
 def parse_non_collection_saved_posts(saved_posts_raw):
     saved_posts = []
     for p in saved_posts_raw['saved_saved_media']:
-        reel = {
-            'id':shortuuid.ShortUUID().random(length=4),
-            'account':p['title'] if 'title' in p else None,
-            'url':p['string_map_data']['Saved on']['href'],
-            'date_saved':datetime.fromtimestamp(p['string_map_data']['Saved on']['timestamp']),
-            'collection':None,
-            'post_type':get_post_type(p['string_map_data']['Saved on']['href'])
-        }
+        reel = parse_non_collection_entry(p)
         saved_posts.append(reel)
     return saved_posts
 
+# what can follow a complete number or literal inside an object or array
+JSON_DELIMITERS = ',]} \t\r\n'
+
+class JsonStream:
+    """
+    Minimal incremental reader over a json text file.
+    Only the part of the file that has not been consumed yet is kept in memory.
+    """
+    def __init__(self, f, chunk_size=1 << 16):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def fill(self):
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        # drop everything that was already consumed
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        # skip whitespace and return the next significant character ('' at EOF)
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, *chars):
+        c = self.peek()
+        if c not in chars:
+            raise ValueError(f"Malformed json: expected one of {chars} but found {c!r}")
+        self.pos += 1
+        return c
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a number (or literal) is only complete once a delimiter follows it, "1." or "-2.5e"
+                # at the end of the buffer decode as a shorter number and continue in the next chunk
+                if isinstance(obj, (dict, list, str)) or self.eof or (end < len(self.buf) and self.buf[end] in JSON_DELIMITERS):
+                    self.pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+def iter_json_array(f, key, chunk_size=1 << 16):
+    """
+    Yield the elements of the array stored under `key` in a top level json object
+    one at a time, without loading the whole file.
+    """
+    stream = JsonStream(f, chunk_size)
+    stream.expect('{')
+    if stream.peek() == '}':
+        return
+    while True:
+        k = stream.value()
+        stream.expect(':')
+        if k == key:
+            stream.expect('[')
+            if stream.peek() == ']':
+                return
+            while True:
+                yield stream.value()
+                if stream.expect(',', ']') == ']':
+                    return
+        # some other key, decode its value and throw it away
+        stream.value()
+        if stream.expect(',', '}') == '}':
+            return
+
+def batched(iterable, batch_size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def bounded_map(executor, fn, items, window):
+    """
+    executor.map that submits at most window items ahead of the one being consumed,
+    results still come back in order. map submits every item up front and keeps
+    every result that is not consumed yet in memory.
+    """
+    items = iter(items)
+    pending = deque(executor.submit(fn, item) for item in islice(items, window))
+    while pending:
+        future = pending.popleft()
+        # keep the pool busy while the caller works on this result
+        for item in islice(items, 1):
+            pending.append(executor.submit(fn, item))
+        yield future.result()
+
+def iter_saved_posts(f):
+    # the collection title is an entry of its own, every post after it belongs to that collection
+    current_collection_title = None
+    for p in iter_json_array(f, 'saved_saved_collections'):
+        if 'title' in p.keys():
+            current_collection_title = p['string_map_data']['Name']['value']
+        else:
+            yield parse_collection_entry(p, current_collection_title)
+
+def iter_non_collection_saved_posts(f):
+    for p in iter_json_array(f, 'saved_saved_media'):
+        yield parse_non_collection_entry(p)
+
+def iter_takeout_file(filepath, batch_size=500):
+    """
+    Streaming version of parse_saved_posts / parse_non_collection_saved_posts.
+    Yields lists of at most batch_size posts as they are read from the takeout file.
+    """
+    file_type = detect_file_type(filepath)
+    with open(filepath) as f:
+        if file_type == "collection":
+            posts = iter_saved_posts(f)
+        elif file_type == "non_collection":
+            posts = iter_non_collection_saved_posts(f)
+        yield from batched(posts, batch_size)
+
+def parse_takeout_file(filepath):
+    """Parse a whole takeout file into a list of posts (used by the import-takeouts process pool)"""
+    posts = []
+    for batch in iter_takeout_file(filepath):
+        posts.extend(batch)
+    return posts
+
+def find_takeout_files(root, directories=None):
+    """
+    Look for takeout files in every root/instagram-*/ directory, or only in the given ones.
+    Returns (collection files, non collection files), each sorted by directory.
+    """
+    collection_files = []
+    non_collection_files = []
+    for entry in sorted(os.scandir(root), key=lambda e: e.name):
+        if not entry.is_dir() or not entry.name.startswith("instagram-"):
+            continue
+        if directories is not None and entry.path not in directories:
+            continue
+        saved_folder = os.path.join(entry.path, "your_instagram_activity", "saved")
+        json_collection_path = os.path.join(saved_folder, "saved_collections.json")
+        json_non_collection_path = os.path.join(saved_folder, "saved_posts.json")
+        if os.path.isfile(json_collection_path):
+            collection_files.append(json_collection_path)
+        else:
+            print(f"No saved_collections.json in {entry.path}")
+        if os.path.isfile(json_non_collection_path):
+            non_collection_files.append(json_non_collection_path)
+        else:
+            print(f"No saved_posts.json in {entry.path}")
+    return collection_files, non_collection_files
+
 """
 #Code for transfering saved posts pickle to db
 # read pickle file containing parsed posts
@@ -0,0 +1,220 @@
+"""
+Long running mode: import new takeouts as they show up and keep the download queue drained.
+
+Instead of cron starting parse.sh and a new `db.py download` every few minutes, one process
+keeps its engine, session and Downloader (instaloader context, connection pool and rate
+limiter) for as long as it runs. New root/instagram-*/ directories are noticed with inotify
+(linux, through ctypes) or by polling where that is not available, and imported once their
+files stopped changing. SIGTERM / ctrl+c stop it after the running downloads are recorded,
+posts that did not start stay in the queue.
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import signal
+import threading
+import time
+from datetime import datetime
+from itertools import islice
+
+import metrics
+from commands import count_download_backlog, import_takeouts, iter_download_queue, make_downloader, run_downloads
+from utils import DOWNLOAD_CHUNK_SIZE, MEDIA_RATE
+
+# posts downloaded before looking for new takeouts again
+PASS_SIZE = 100
+# seconds between looks at the queue (retries becoming due) and, without inotify, at root
+POLL_INTERVAL = 60
+# a takeout is imported once none of its files changed for this many seconds
+SETTLE_TIME = 10
+
+# inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+
+class InotifyWatcher:
+    """Wakes up when something is created in, moved into or written to a directory"""
+    def __init__(self, path):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"inotify_add_watch failed for {path}")
+
+    def wait(self, timeout):
+        """True if something happened within timeout seconds"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+        # only the wake up matters, what changed is found by looking at the directory
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """Fallback without inotify, every wait just times out and the directory is looked at again"""
+    def wait(self, timeout):
+        time.sleep(timeout)
+        return False
+
+    def close(self):
+        pass
+
+
+def open_watcher(path, poll_interval=POLL_INTERVAL):
+    try:
+        return InotifyWatcher(path)
+    except (OSError, AttributeError) as e:
+        # not linux (no inotify_init1 in libc), or out of watches
+        print(f"inotify not available ({e}), looking for new takeouts every {poll_interval}s")
+        return PollingWatcher()
+
+
+def directory_signature(path):
+    """(number of files, total size, newest mtime) of everything under path"""
+    files, size, newest = 0, 0, os.stat(path).st_mtime
+    for folder, _, names in os.walk(path):
+        for name in names:
+            try:
+                stat = os.stat(os.path.join(folder, name))
+            except FileNotFoundError:
+                # removed while walking (an unzip moving things around)
+                continue
+            files += 1
+            size += stat.st_size
+            newest = max(newest, stat.st_mtime)
+    return files, size, newest
+
+
+class TakeoutFolder:
+    """The instagram-*/ directories under root, and which of them are new since the last import"""
+    def __init__(self, root, settle=SETTLE_TIME):
+        self.root = root
+        self.settle = settle
+        # path -> mtime of the directory itself when it was imported
+        self.imported = {}
+
+    def pending(self):
+        """
+        {path: signature} of the directories that are new, or whose own mtime changed, since
+        their import. Imported directories are not walked again.
+        """
+        pending = {}
+        for entry in os.scandir(self.root):
+            if not entry.is_dir() or not entry.name.startswith("instagram-"):
+                continue
+            mtime = entry.stat().st_mtime
+            if self.imported.get(entry.path) == mtime:
+                continue
+            pending[entry.path] = (mtime, *directory_signature(entry.path))
+        return pending
+
+    def wait_time(self, pending):
+        """Seconds until every pending directory has been left alone for settle seconds, 0 when it has"""
+        if not pending:
+            return 0
+        newest = max(signature[3] for signature in pending.values())
+        return max(0, newest + self.settle - time.time())
+
+    def mark_imported(self, pending):
+        self.imported.update((path, signature[0]) for path, signature in pending.items())
+
+
+def wait_for_change(watcher, timeout, stop):
+    """Sleep up to timeout seconds, less if root changes or stop is set"""
+    deadline = time.monotonic() + timeout
+    while not stop.is_set():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        # short slices so a stop request never waits for a long timeout
+        if watcher.wait(min(remaining, 1)):
+            return True
+    return False
+
+
+def ingest(session, root, takeouts, pending):
+    print(f"{datetime.now():%Y-%m-%d %H:%M:%S} importing {', '.join(sorted(os.path.basename(path) for path in pending))}")
+    try:
+        # only the settled directories, the ingested_files ledger still skips a file seen before
+        import_takeouts(session, root, directories=set(pending))
+    except Exception as e:
+        # a broken takeout must not stop the downloads, it is tried again once its directory changes
+        session.rollback()
+        print(f"Import failed: {e!r}")
+    takeouts.mark_imported(pending)
+
+
+def watch(session, root='takeout_files', workers=1, batch_size=10, rate=0.5, max_rate=2.0,
+          chunk_size=DOWNLOAD_CHUNK_SIZE, store_root=None, pass_size=PASS_SIZE,
+          poll_interval=POLL_INTERVAL, settle=SETTLE_TIME, media_rate=MEDIA_RATE):
+    """
+    Run until SIGTERM / ctrl+c: import takeouts that appear under root and download
+    the queue pass_size posts at a time, looking for new takeouts between passes.
+    When the queue is empty it sleeps until root changes or poll_interval passed
+    (failed posts become due for a retry while it sleeps).
+    """
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        if stop.is_set():
+            # the running downloads are still recorded, every media request has a timeout so this ends
+            print(f"\n{signal.Signals(signum).name} received, already stopping, waiting for the running downloads.")
+            return
+        print(f"\n{signal.Signals(signum).name} received, finishing the running downloads.")
+        stop.set()
+
+    previous_handlers = {signum: signal.signal(signum, request_stop) for signum in (signal.SIGTERM, signal.SIGINT)}
+
+    os.makedirs(root, exist_ok=True)
+    takeouts = TakeoutFolder(root, settle)
+    watcher = open_watcher(root, poll_interval)
+
+    collection_posts, non_collection_posts, retries_due = count_download_backlog(session)
+    print(f"Watching {root} | Queued: {collection_posts + non_collection_posts} new posts, {retries_due} retries due")
+
+    downloader = make_downloader(workers, rate, max_rate, chunk_size, store_root, media_rate)
+    page_size = max(batch_size, workers * 2)
+    processed = 0
+    try:
+        while not stop.is_set():
+            pending = takeouts.pending()
+            delay = takeouts.wait_time(pending)
+            if pending and not delay:
+                with metrics.phase('ingest'):
+                    ingest(session, root, takeouts, pending)
+                continue
+
+            queue = islice(iter_download_queue(session, page_size), pass_size)
+            done = run_downloads(session, downloader, queue, workers, batch_size, stop)
+            processed += done
+            if done:
+                print(f"{datetime.now():%Y-%m-%d %H:%M:%S} processed {done} posts ({processed} since start) | {downloader.limiter}")
+                continue
+
+            # nothing to download: wait for a takeout to settle, for root to change or for retries to become due
+            wait_for_change(watcher, delay if pending else poll_interval, stop)
+    finally:
+        downloader.close()
+        watcher.close()
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+
+    print(f"Stopped. Processed {processed} posts.")
+    print("Rate limiter: ", downloader.limiter.stats())
+    print("Media rate limiter: ", downloader.media_limiter.stats())